@@ -0,0 +1,41 @@
+'''
+Micro-benchmark of Context.get_prompt latency over a long session.
+
+Simulates a 10k turn conversation (user message followed by a response),
+timing get_prompt after every add. Latency should stay flat as the session
+grows, as the context only ever holds what fits in the window.
+
+Run from the project root:
+
+    python -m benchmarks.bench_context
+'''
+import sys
+import time
+
+from chat_agent.memory.context import Context
+
+
+def benchmark(n_turns=10000, report_every=1000, max_context=4096):
+    context = Context('You are a helpful assistant.',
+                      num_response_tokens=256,
+                      max_context_tokens=max_context)
+    timings = []
+    print(f'{"turns":>8} {"messages":>9} {"tokens":>7} {"mean us":>8} {"max us":>8}')
+    for turn in range(1, n_turns + 1):
+        for role in ['user', 'assistant']:
+            # token counts are given so that only the context is measured
+            context.add(role=role, text=f'{role} message {turn}', n_tokens=20 + turn % 40)
+            start = time.perf_counter()
+            context.get_prompt()
+            timings.append(time.perf_counter() - start)
+
+        if turn % report_every == 0:
+            mean = sum(timings) / len(timings) * 1e6
+            print(f'{turn:>8} {len(context):>9} {context.n_tokens:>7} '
+                  f'{mean:>8.2f} {max(timings) * 1e6:>8.2f}')
+            timings = []
+
+
+if __name__ == '__main__':
+    n_turns = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    benchmark(n_turns)
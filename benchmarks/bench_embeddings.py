@@ -0,0 +1,59 @@
+'''
+Throughput of the search tool's embedding backends, in chunks per second.
+
+Embeds synthetic 500 character chunks (the size the search tool splits
+pages into) in batches, as the search tool does, with each backend given.
+
+Run from the project root, e.g.
+
+    python -m benchmarks.bench_embeddings --backends hashing fake
+    python -m benchmarks.bench_embeddings --backends hashing sentence_transformers openai
+'''
+import argparse
+import time
+
+import numpy as np
+
+from chat_agent.tools.embeddings import get_embeddings
+
+
+def make_chunks(n_chunks, chunk_size=500, seed=0):
+    rng = np.random.default_rng(seed)
+    vocabulary = [''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyz'), size=rng.integers(2, 10)))
+                  for _ in range(5000)]
+    chunks = []
+    for _ in range(n_chunks):
+        words = []
+        while sum(len(word) + 1 for word in words) < chunk_size:
+            words.append(vocabulary[min(int(rng.zipf(1.3)), len(vocabulary)) - 1])
+        chunks.append(' '.join(words)[:chunk_size])
+    return chunks
+
+
+def benchmark(backend, chunks, batch_size):
+    start = time.perf_counter()
+    embeddings = get_embeddings({'type': backend})
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for indx in range(0, len(chunks), batch_size):
+        embeddings.embed_documents(chunks[indx:indx + batch_size])
+    elapsed = time.perf_counter() - start
+    print(f'{backend:>22} {load_time:>9.2f} {len(chunks) / elapsed:>12.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark embedding backends')
+    parser.add_argument('--backends', nargs='+', default=['hashing', 'fake'])
+    parser.add_argument('--chunks', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks)
+    print(f'{args.chunks} chunks of up to 500 characters, batches of {args.batch_size}')
+    print(f'{"backend":>22} {"load (s)":>9} {"chunks/sec":>12}')
+    for backend in args.backends:
+        benchmark(backend, chunks, args.batch_size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''
+Saving from main-content extraction, over the saved pages in
+benchmarks/fixtures.
+
+For each page, compares the whole page's text with its main content only:
+characters of text, and chunks (so embedding calls, and entries in the
+vector DB), along with the time taken to extract them.
+
+Run from the project root:
+
+    python -m benchmarks.bench_extraction
+'''
+import glob
+import os
+import time
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from chat_agent.tools.html_text import page_chunks, default_parser
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def main():
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
+    parser = default_parser()
+    totals = {'whole': [0, 0, 0], 'main': [0, 0, 0]}
+    print(f'{"page":>16} {"chars":>7} {"kept":>7} {"chunks":>7} {"kept":>7}')
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        results = {}
+        for name, main_content in [('whole', False), ('main', True)]:
+            start = time.perf_counter()
+            chunks, stats = page_chunks(html, text_splitter, parser, main_content=main_content)
+            elapsed = time.perf_counter() - start
+            results[name] = (stats['kept'], len(chunks))
+            for indx, value in enumerate([stats['kept'], len(chunks), elapsed]):
+                totals[name][indx] += value
+        name = os.path.splitext(os.path.basename(path))[0]
+        print(f'{name:>16} {results["whole"][0]:>7} {results["main"][0]:>7} '
+              f'{results["whole"][1]:>7} {results["main"][1]:>7}')
+
+    whole, main = totals['whole'], totals['main']
+    print(f'{"total":>16} {whole[0]:>7} {main[0]:>7} {whole[1]:>7} {main[1]:>7}')
+    print(f'Main content keeps {main[0] / whole[0]:.0%} of the text and {main[1] / whole[1]:.0%} '
+          f'of the chunks; extraction takes {main[2] * 1000:.0f} ms vs {whole[2] * 1000:.0f} ms')
+
+if __name__ == '__main__':
+    main()
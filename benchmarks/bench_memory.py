@@ -0,0 +1,103 @@
+'''
+Latency of recalling long-term memories, at 100k memories.
+
+Fills a long-term memory (in a temporary directory) with synthetic turns,
+embedded with the hashing embedder, in batches as the agent would add
+them, then times recalls: the index search and fetching the memories
+(given the query's vector), and the whole recall including embedding the
+query. Also reports how many of the exact 5 nearest memories the HNSW
+index finds (recall@5).
+
+Run from the project root:
+
+    python -m benchmarks.bench_memory
+    python -m benchmarks.bench_memory --memories 20000 --queries 500
+'''
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from chat_agent.memory.long_term import LongTermMemory
+from chat_agent.memory.tokenizers import get_tokenizer
+from chat_agent.tools.embeddings import HashingEmbeddings
+
+WORDS = ('weather forecast hike trail dog cat recipe peanut allergy cello music concert '
+         'flight hotel Moab Denver Utah birthday gift sister brother doctor appointment '
+         'python code bug meeting budget garden tomato bike repair movie book author '
+         'coffee tea running marathon train ticket museum painting camera lens').split()
+
+
+def synthetic_turn(rng):
+    question = ' '.join(rng.choices(WORDS, k=rng.randint(5, 12)))
+    answer = ' '.join(rng.choices(WORDS, k=rng.randint(10, 30)))
+    return f'User: {question}\nAI: {answer}'
+
+
+def percentile(timings, percent):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * percent / 100))] * 1000
+
+
+def benchmark(n_memories, n_queries, batch_size=1000, seed=0):
+    rng = random.Random(seed)
+    path = tempfile.mkdtemp()
+    embeddings = HashingEmbeddings()
+    try:
+        memory = LongTermMemory(path, embeddings, get_tokenizer({'type': 'estimate'}),
+                                compact_every=n_memories // 4)
+        start = time.monotonic()
+        for first in range(0, n_memories, batch_size):
+            memory.add([synthetic_turn(rng) for _ in range(min(batch_size, n_memories - first))])
+        elapsed = time.monotonic() - start
+        print(f'Added {len(memory)} memories in {elapsed:.1f}s '
+              f'({len(memory) / elapsed:.0f}/s, embedding included)')
+        if memory.compactor is not None:
+            memory.compactor.join()
+
+        queries = [synthetic_turn(rng).split('\n')[0] for _ in range(n_queries)]
+        vectors = np.array(embeddings.embed_documents(queries), dtype='float32')
+        search_timings = []
+        for vector in vectors:
+            start = time.perf_counter()
+            memory.search(vector[None, :], k=5, max_tokens=512)
+            search_timings.append(time.perf_counter() - start)
+        recall_timings = []
+        for query in queries:
+            start = time.perf_counter()
+            memory.recall(query, k=5, max_tokens=512)
+            recall_timings.append(time.perf_counter() - start)
+        print(f'Search (index and fetch): p50 {percentile(search_timings, 50):.2f} ms, '
+              f'p99 {percentile(search_timings, 99):.2f} ms')
+        print(f'Recall (with query embedding): p50 {percentile(recall_timings, 50):.2f} ms, '
+              f'p99 {percentile(recall_timings, 99):.2f} ms')
+
+        # compare with exact search over the same vectors
+        hnsw = faiss.downcast_index(memory.index.index)
+        exact = faiss.IndexFlatL2(hnsw.d)
+        exact.add(hnsw.storage.reconstruct_n(0, hnsw.ntotal))
+        _, approximate_ids = hnsw.search(vectors, 5)
+        _, exact_ids = exact.search(vectors, 5)
+        found = np.mean([len(set(a) & set(e)) / 5 for a, e in zip(approximate_ids, exact_ids)])
+        print(f'Recall@5 against exact search: {found:.1%}')
+
+        start = time.monotonic()
+        memory.compact()
+        print(f'Compaction (snapshot of the index): {time.monotonic() - start:.2f}s')
+        start = time.monotonic()
+        LongTermMemory(path, embeddings, get_tokenizer({'type': 'estimate'}))
+        print(f'Loading: {time.monotonic() - start:.2f}s')
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--memories', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+    benchmark(args.memories, args.queries)
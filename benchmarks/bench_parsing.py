@@ -0,0 +1,75 @@
+'''
+Throughput of parsing pages and splitting them into chunks, in pages per
+second, with 1..N workers.
+
+Parses the saved pages in benchmarks/fixtures (repeated to make up
+--pages pages) with the search tool's extraction, in a pool of worker
+processes (or threads), as the scraper does, and inline for comparison.
+
+Run from the project root, e.g.
+
+    python -m benchmarks.bench_parsing --workers 4 --parser lxml
+'''
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from chat_agent.tools.html_text import page_chunks, default_parser
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_pages(n_pages):
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            fixtures.append(f.read())
+    return [fixtures[indx % len(fixtures)] for indx in range(n_pages)]
+
+
+def benchmark(pages, text_splitter, parser, pool, workers):
+    if pool == 'inline':
+        start = time.perf_counter()
+        n_chunks = sum(len(page_chunks(page, text_splitter, parser)[0]) for page in pages)
+        return len(pages) / (time.perf_counter() - start), n_chunks
+
+    if pool == 'process':
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(workers)
+    with executor:
+        # start the workers before timing
+        list(executor.map(page_chunks, pages[:workers], [text_splitter] * workers, [parser] * workers))
+        start = time.perf_counter()
+        results = list(executor.map(page_chunks, pages, [text_splitter] * len(pages),
+                                    [parser] * len(pages)))
+        elapsed = time.perf_counter() - start
+    return len(pages) / elapsed, sum(len(chunks) for chunks, _ in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing and chunking pages')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--pool', choices=['process', 'thread'], default='process')
+    parser.add_argument('--parser', default=default_parser())
+    args = parser.parse_args()
+
+    pages = load_pages(args.pages)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
+    print(f'{len(pages)} pages ({sum(len(page) for page in pages) / 1e6:.1f} MB) with '
+          f'{args.parser}, {os.cpu_count()} CPUs')
+    print(f'{"pool":>8} {"workers":>8} {"pages/sec":>10} {"chunks":>8}')
+    pages_sec, n_chunks = benchmark(pages, text_splitter, args.parser, 'inline', 1)
+    print(f'{"inline":>8} {1:>8} {pages_sec:>10.1f} {n_chunks:>8}')
+    for workers in range(1, args.workers + 1):
+        pages_sec, n_chunks = benchmark(pages, text_splitter, args.parser, args.pool, workers)
+        print(f'{args.pool:>8} {workers:>8} {pages_sec:>10.1f} {n_chunks:>8}')
+
+if __name__ == '__main__':
+    main()
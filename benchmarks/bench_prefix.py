@@ -0,0 +1,50 @@
+'''
+Share of each prompt which repeats the start of the prompt before it, and
+so could be read from a provider's prompt cache, over a long session.
+
+Simulates a conversation of user messages and responses, comparing each
+prompt with the previous one message by message, with the context evicting
+just enough to fit each new message (compact_to=1) and compacting in blocks
+(compact_to=0.5 by default).
+
+Run from the project root:
+
+    python -m benchmarks.bench_prefix
+'''
+import random
+import sys
+
+from chat_agent.memory.context import Context
+from chat_agent.memory.tokenizers import get_tokenizer
+
+
+def run(compact_to, n_turns, max_context=4096, seed=0):
+    rng = random.Random(seed)
+    pretext = 'You are a helpful assistant. ' * 250
+    context = Context(pretext, num_response_tokens=256, max_context_tokens=max_context,
+                      compact_to=compact_to, tokenizer=get_tokenizer({'type': 'estimate'}))
+    n_tokens = {id(context.get_prompt()[0]): context.num_pretext_tokens}
+    previous = []
+    shared = total = 0
+    for turn in range(n_turns):
+        for role in ['user', 'assistant']:
+            count = rng.randint(20, 300)
+            context.add(role=role, text=f'{role} message {turn}', n_tokens=count)
+            n_tokens[id(context.get_prompt()[-1])] = count
+
+        prompt = context.get_prompt()
+        for old, new in zip(previous, prompt):
+            if old is not new:
+                break
+            shared += n_tokens[id(new)]
+        total += sum(n_tokens[id(message)] for message in prompt)
+        previous = prompt
+    return shared / total
+
+
+if __name__ == '__main__':
+    n_turns = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    compact_to = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    for setting in [1.0, compact_to]:
+        print(f'compact_to={setting}: {run(setting, n_turns):.0%} of prompt tokens '
+              'repeat the start of the previous prompt')
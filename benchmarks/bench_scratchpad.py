@@ -0,0 +1,68 @@
+'''
+Regression benchmark of prompt size over a multi-step ReAct task.
+
+Plays out a 10 step task, each step being a response with an action and an
+observation of the tool's result, and counts the prompt tokens sent to the
+LLM at each step. This is compared with the previous behavior of appending
+each observation to the cumulative user message and re-adding it every
+step, which grows quadratically.
+
+Run from the project root:
+
+    python -m benchmarks.bench_scratchpad
+'''
+import sys
+
+from chat_agent.memory.context import Context
+from chat_agent.memory.tokenizers import get_tokenizer
+
+
+RESPONSE = 'Thought: I need to look up more.\nAction: search\nAction Input: step {step}'
+OBSERVATION = ' '.join(['Some relevant finding from the search results.'] * 40)
+
+
+def count_tokens(context, tokenizer):
+    return sum([tokenizer.count(message['content']) for message in context.get_prompt()])
+
+
+def run_task(n_steps, cumulative, max_observation_tokens=None):
+    tokenizer = get_tokenizer()
+    context = Context('You are a helpful assistant.',
+                      num_response_tokens=256,
+                      max_context_tokens=1000000,
+                      max_observation_tokens=max_observation_tokens,
+                      tokenizer=tokenizer)
+    text = 'Research something for me.'
+    context.add(role='user', text=text)
+    prompt_tokens = []
+    for step in range(1, n_steps + 1):
+        prompt_tokens.append(count_tokens(context, tokenizer))
+        context.add(role='assistant', text=RESPONSE.format(step=step))
+        if cumulative:
+            text = f'{text}\n\nObservation: {OBSERVATION}'
+            context.add(role='user', text=text)
+        else:
+            context.add_observation(OBSERVATION)
+    prompt_tokens.append(count_tokens(context, tokenizer))
+    return prompt_tokens
+
+
+def benchmark(n_steps=10):
+    results = {'cumulative': run_task(n_steps, cumulative=True),
+               'scratchpad': run_task(n_steps, cumulative=False),
+               'truncated (64)': run_task(n_steps, cumulative=False,
+                                          max_observation_tokens=64)}
+    print(f'{"step":>5}' + ''.join([f'{name:>16}' for name in results.keys()]))
+    for step in range(n_steps + 1):
+        print(f'{step:>5}' + ''.join([f'{tokens[step]:>16}' for tokens in results.values()]))
+    print(f'{"total":>5}' + ''.join([f'{sum(tokens):>16}' for tokens in results.values()]))
+
+    # each step of the scratchpad should add a constant number of tokens
+    tokens = results['scratchpad']
+    growth = [tokens[indx + 1] - tokens[indx] for indx in range(len(tokens) - 1)]
+    assert max(growth) - min(growth) <= 2, f'Prompt growth is not linear: {growth}'
+
+
+if __name__ == '__main__':
+    n_steps = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    benchmark(n_steps)
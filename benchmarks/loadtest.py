@@ -0,0 +1,128 @@
+'''
+Load test of the multi-session server with the fake (scripted) LLM.
+
+Starts the server on a local port, opens N concurrent sessions over
+WebSockets (or with POST requests) and has each of them take a number of
+turns, then reports p50/p99 time to first message and turn latency.
+
+Run from the project root, e.g.
+
+    python -m benchmarks.loadtest --sessions 200 --turns 5
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from chat_agent.chatagent import AgentResources, setup_logging
+from chat_agent.sessions import SessionManager
+from chat_agent.server import create_app
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def websocket_session(session, url, session_id, n_turns, results):
+    async with session.ws_connect(f'{url}/sessions/{session_id}/ws') as ws:
+        for turn in range(n_turns):
+            start = time.perf_counter()
+            first = None
+            await ws.send_str(f'message {turn} from {session_id}')
+            async for msg in ws:
+                message = json.loads(msg.data)
+                if 'error' in message:
+                    results['errors'] += 1
+                    break
+                if first is None:
+                    first = time.perf_counter() - start
+                if message['done']:
+                    break
+            results['first'].append(first)
+            results['turn'].append(time.perf_counter() - start)
+
+
+async def post_session(session, url, session_id, n_turns, results):
+    for turn in range(n_turns):
+        start = time.perf_counter()
+        first = None
+        async with session.post(f'{url}/sessions/{session_id}/messages',
+                                json={'text': f'message {turn} from {session_id}'}) as response:
+            if response.status != 200:
+                results['errors'] += 1
+                continue
+            async for line in response.content:
+                if first is None:
+                    first = time.perf_counter() - start
+                if 'error' in json.loads(line):
+                    results['errors'] += 1
+        results['first'].append(first)
+        results['turn'].append(time.perf_counter() - start)
+
+
+async def load_test(n_sessions, n_turns, use_post, config, port=8765):
+    temp_dir = tempfile.mkdtemp()
+    setup_logging(os.path.join(temp_dir, 'logs'))
+    manager = SessionManager(AgentResources(config=config, tools=[]),
+                             max_sessions=n_sessions,
+                             max_concurrent_turns=n_sessions,
+                             chat_dir=os.path.join(temp_dir, 'chats'))
+    runner = web.AppRunner(create_app(manager))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    url = f'http://127.0.0.1:{port}'
+    results = {'first': [], 'turn': [], 'errors': 0}
+    client = post_session if use_post else websocket_session
+    connector = aiohttp.TCPConnector(limit=n_sessions)
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session, url, f'session{indx}', n_turns, results)
+                               for indx in range(n_sessions)])
+    elapsed = time.perf_counter() - start
+    await runner.cleanup()
+
+    first = [value for value in results['first'] if value is not None]
+    print(f'{n_sessions} sessions x {n_turns} turns over '
+          f'{"POST" if use_post else "WebSocket"} in {elapsed:.2f}s '
+          f'({len(results["turn"]) / elapsed:.1f} turns/s), {results["errors"]} errors')
+    if len(first) > 0:
+        print(f'time to first message: p50 {statistics.median(first) * 1000:.1f} ms, '
+              f'p99 {percentile(first, 99) * 1000:.1f} ms')
+    print(f'turn latency:          p50 {statistics.median(results["turn"]) * 1000:.1f} ms, '
+          f'p99 {percentile(results["turn"], 99) * 1000:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the chat agent server')
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--post', action='store_true', help='use POST rather than WebSockets')
+    parser.add_argument('--first-token-delay', type=float, default=0.2)
+    parser.add_argument('--token-delay', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of model calls which fail')
+    args = parser.parse_args()
+
+    config = {'provider': 'chat_fake',
+              'model': 'fake',
+              'tokenizer': {'type': 'estimate', 'chars_per_token': 4},
+              'max_context': 4096,
+              'max_tokens': 256,
+              'first_token_delay': args.first_token_delay,
+              'token_delay': args.token_delay,
+              'error_rate': args.error_rate,
+              'responses': ['Thought: The user sent a message.\nFinal Answer: Thank you for '
+                            'your message. This is a scripted response, streamed a word at a '
+                            'time. Is there anything else?']}
+    asyncio.run(load_test(args.sessions, args.turns, args.post, config))
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,215 @@
 import os
+import asyncio
+import importlib
 import logging
+from contextvars import ContextVar
 from dotenv import load_dotenv
+try:
+    from chat_agent.memory.tokenizers import get_tokenizer
+    from chat_agent.LLMs.completion_cache import CompletionCache
+except:
+    from memory.tokenizers import get_tokenizer
+    from LLMs.completion_cache import CompletionCache
+
+
+# token usage reported for the current call, per thread or task
+_usage = ContextVar('usage', default=None)
+
+
+def load_chat_model(config):
+    '''
+    Create the chat model of the configuration's provider
+    '''
+    try:
+        provider = importlib.import_module('chat_agent.LLMs.' + config['provider'].strip())
+    except:
+        provider = importlib.import_module('LLMs.' + config['provider'].strip())
+    return provider.ChatModel(config)
 
 
 class ChatBase:
+    # models which run one call at a time on one session (such as a local
+    # model), which background calls would hold up, and disturb
+    exclusive = False
+    # the temperature sent when none is configured (None, the provider's
+    # own default, which samples)
+    default_temperature = None
+
     def __init__(self, config):
         load_dotenv()
-        self.api_key = os.getenv(config.get('api_key'))
+        self.api_key = os.getenv(config['api_key']) if 'api_key' in config else None
         self.config = config
         self.logger = logging.getLogger('chat_log')
         self.logger.info(f'Using configuration {self.config}')
+        self.tokenizer = get_tokenizer(config.get('tokenizer'))
+
+        # opt in completion cache, e.g. "cache": {"ttl": 86400, "max_entries": 10000}
+        self.cache = None
+        cache_config = config.get('cache')
+        if cache_config:
+            cache_config = cache_config if isinstance(cache_config, dict) else {}
+            path = cache_config.get('path', os.path.join(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'completions.sqlite'))
+            self.cache = CompletionCache(path, ttl=cache_config.get('ttl', 86400),
+                                         max_entries=cache_config.get('max_entries', 10000))
+            self.cache_any_temperature = cache_config.get('any_temperature', False)
 
-    def __call__(self, prompt):
+    def __call__(self, prompt, stream=False, cache=None):
+        '''
+        Call the model. With stream, returns an iterator of chunks of text.
+
+        With the completion cache enabled, responses are cached when the
+        temperature sent is 0, or when cache is True; cache False bypasses
+        it.
+        '''
         self.logger.info(f'Prompt: {prompt[-1]}')
+        _usage.set({})
+        key = self.__cache_key(prompt, cache)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.logger.info('Completion cache hit')
+                self.record_usage(**cached[1])
+                return self.__replay(cached[0]) if stream else cached[0]
+            if stream:
+                return self.__cache_stream(self.stream(prompt), key)
+            completion = self.complete(prompt)
+            self.cache.put(key, completion, self.usage)
+            return completion
+        if stream:
+            return self.stream(prompt)
         return self.complete(prompt)
-    
+
+    async def acall(self, prompt, stream=False, cache=None):
+        '''
+        Asynchronous version of calling the model. With stream, returns
+        an async iterator of chunks of text.
+        '''
+        self.logger.info(f'Prompt: {prompt[-1]}')
+        _usage.set({})
+        key = self.__cache_key(prompt, cache)
+        if key is not None:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                self.logger.info('Completion cache hit')
+                self.record_usage(**cached[1])
+                return self.__areplay(cached[0]) if stream else cached[0]
+            if stream:
+                return self.__acache_stream(self.astream(prompt), key)
+            completion = await self.acomplete(prompt)
+            await asyncio.to_thread(self.cache.put, key, completion, self.usage)
+            return completion
+        if stream:
+            return self.astream(prompt)
+        return await self.acomplete(prompt)
+
+    @property
+    def cache_stats(self):
+        '''
+        Hits and misses of the completion cache, if enabled
+        '''
+        if self.cache is None:
+            return None
+        return {**self.cache.stats, 'hit_ratio': self.cache.hit_ratio}
+
+    @property
+    def temperature(self):
+        '''
+        The temperature sent to the model, or None for the provider's default
+        '''
+        return self.config.get('temperature', self.default_temperature)
+
+    @property
+    def usage(self):
+        '''
+        Token usage reported by the provider for the last call made in
+        this thread (or task), if any: prompt_tokens and completion_tokens,
+        and cached_tokens, those of the prompt read from the provider's
+        prompt cache
+        '''
+        usage = _usage.get()
+        return usage if usage is not None else {}
+
+    def record_usage(self, prompt_tokens=None, completion_tokens=None, cached_tokens=None):
+        usage = _usage.get()
+        if usage is None:
+            usage = {}
+            _usage.set(usage)
+        if prompt_tokens is not None:
+            usage['prompt_tokens'] = prompt_tokens
+        if completion_tokens is not None:
+            usage['completion_tokens'] = completion_tokens
+        if cached_tokens is not None:
+            usage['cached_tokens'] = cached_tokens
+
     def complete(self, prompt):
         raise NotImplementedError('complete method not implemented')
-    
\ No newline at end of file
+
+    def stream(self, prompt):
+        '''
+        Yield the response in chunks of text as they are generated. Providers
+        which cannot stream fall back to yielding the whole completion once.
+        Closing the generator early cancels the rest of the generation.
+        '''
+        yield self.complete(prompt)
+
+    async def acomplete(self, prompt):
+        '''
+        Providers without an asynchronous client run complete() in a
+        worker thread
+        '''
+        return await asyncio.to_thread(self.complete, prompt)
+
+    def __cache_key(self, prompt, cache):
+        if self.cache is None or cache is False:
+            return None
+        temperature = self.temperature
+        if cache or self.cache_any_temperature or temperature == 0:
+            # keyed by the temperature actually sent
+            config = {key: value for key, value in self.config.items() if key != 'temperature'}
+            if temperature is not None:
+                config['temperature'] = temperature
+            return self.cache.key(prompt, config)
+        return None
+
+    def __replay(self, completion):
+        yield completion
+
+    async def __areplay(self, completion):
+        yield completion
+
+    def __cache_stream(self, stream, key):
+        # store the response only once it has been streamed in full
+        chunks = []
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            stream.close()
+        self.cache.put(key, ''.join(chunks), self.usage)
+
+    async def __acache_stream(self, stream, key):
+        chunks = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await stream.aclose()
+        await asyncio.to_thread(self.cache.put, key, ''.join(chunks), self.usage)
+
+    async def astream(self, prompt):
+        '''
+        Providers without an asynchronous client iterate stream() in a
+        worker thread
+        '''
+        stream = self.stream(prompt)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, stream, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            await asyncio.to_thread(stream.close)
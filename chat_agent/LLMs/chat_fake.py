@@ -0,0 +1,60 @@
+'''
+Scripted chat model for running the agent offline. Responses are taken
+in turn from the "responses" list in the configuration (cycling when
+exhausted) and streamed a few words at a time, with configurable delays
+to imitate time to first token and generation speed, and a share of
+calls ("error_rate") which fail, to imitate an unreliable provider. Which
+response is next depends only on the number of responses already in the
+prompt, so one model can be shared by many conversations.
+'''
+import re
+import time
+import random
+import asyncio
+try:
+    from chat_agent.LLMs.chat_base import ChatBase
+except:
+    from LLMs.chat_base import ChatBase
+
+
+class ChatModel(ChatBase):
+    def __init__(self, config):
+        super(ChatModel, self).__init__(config)
+        self.responses = self.config.get('responses',
+                                          ['Thought: The user greeted me.\n'
+                                           'Final Answer: Hello! How can I help you today?'])
+        self.first_token_delay = self.config.get('first_token_delay', 0.2)
+        self.token_delay = self.config.get('token_delay', 0.05)
+        self.words_per_chunk = self.config.get('words_per_chunk', 1)
+        self.error_rate = self.config.get('error_rate', 0)
+
+    def complete(self, prompt):
+        return ''.join(self.stream(prompt))
+
+    def stream(self, prompt):
+        response = self.__next_response(prompt)
+        time.sleep(self.first_token_delay)
+        # split on whitespace, keeping it attached to the preceding word
+        words = re.findall(r'\S+\s*|\s+', response)
+        for indx in range(0, len(words), self.words_per_chunk):
+            if indx > 0:
+                time.sleep(self.token_delay)
+            yield ''.join(words[indx:indx + self.words_per_chunk])
+
+    async def acomplete(self, prompt):
+        return ''.join([chunk async for chunk in self.astream(prompt)])
+
+    async def astream(self, prompt):
+        response = self.__next_response(prompt)
+        await asyncio.sleep(self.first_token_delay)
+        words = re.findall(r'\S+\s*|\s+', response)
+        for indx in range(0, len(words), self.words_per_chunk):
+            if indx > 0:
+                await asyncio.sleep(self.token_delay)
+            yield ''.join(words[indx:indx + self.words_per_chunk])
+
+    def __next_response(self, prompt):
+        if random.random() < self.error_rate:
+            raise RuntimeError('Scripted failure')
+        n_responses = len([message for message in prompt if message.get('role') == 'assistant'])
+        return self.responses[n_responses % len(self.responses)]
@@ -23,11 +23,28 @@ class ChatModel(ChatBase):
         try:
             response = self.model.generate_content(prompt)
         except Exception as ex:
-            print(f'Exception: {ex}')
-            print(f'Context: {prompt}')
-            return "An error occured!"
+            self.logger.error(f'Gemini request failed: {ex}')
+            raise
+        self.__record_usage(response)
         return " ".join([part.text for part in response.candidates[0].content.parts])
+
+    def stream(self, prompt):
+        prompt = self.convert_prompts(prompt)
+        try:
+            response = self.model.generate_content(prompt, stream=True)
+            for chunk in response:
+                yield " ".join([part.text for part in chunk.candidates[0].content.parts])
+            self.__record_usage(response)
+        except Exception as ex:
+            self.logger.error(f'Gemini request failed: {ex}')
+            raise
     
+    def __record_usage(self, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            self.record_usage(usage.prompt_token_count, usage.candidates_token_count,
+                              getattr(usage, 'cached_content_token_count', None))
+
     def convert_prompts(self, prompt):
         parts = [prompt[0]["content"]]
         if len(prompt) > 1:
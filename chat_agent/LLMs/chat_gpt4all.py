@@ -1,20 +1,145 @@
+'''
+Local model, run with gpt4all.
+
+The model keeps one chat session open, so that the messages it has already
+processed (its KV cache) are reused from one call to the next: as long as
+a prompt continues the messages of the previous call and the response
+given to it, exactly as generated, only the new messages are evaluated.
+A prompt which does not (e.g. messages were evicted from the context, a
+response was cut short, or it is from another conversation) starts a new
+session, with the earlier messages folded into its system prompt.
+
+The model is loaded in the background as soon as the chat model is created,
+so that it is ready (or nearly) by the first call. "prompt_template" and
+"system_template" format the turns and the system prompt for the model.
+'''
+import time
+from threading import Thread, Event, Lock
 from gpt4all import GPT4All
 try:
     from chat_agent.LLMs.chat_base import ChatBase
 except:
     from LLMs.chat_base import ChatBase
 
+PROMPT_TEMPLATE = '### Human:\n{0}\n\n### Assistant:\n'
+SYSTEM_TEMPLATE = '{0}\n\n'
+
+# configuration entries passed on to generate()
+GENERATE_PARAMETERS = {'max_tokens': 'max_tokens', 'temperature': 'temp', 'top_k': 'top_k',
+                       'top_p': 'top_p', 'repeat_penalty': 'repeat_penalty', 'n_batch': 'n_batch'}
+
 
 class ChatModel(ChatBase):
+    exclusive = True
+
     def __init__(self, config):
         super(ChatModel, self).__init__(config)
-        self.gpt4all = GPT4All(self.config['model'])
+        self.prompt_template = self.config.get('prompt_template', PROMPT_TEMPLATE)
+        self.system_template = self.config.get('system_template', SYSTEM_TEMPLATE)
+        self.parameters = {name: self.config[key] for key, name in GENERATE_PARAMETERS.items()
+                           if key in self.config}
+        self.gpt4all = None
+        self.load_error = None
+        self.loaded = Event()
+        self.session = None
+        self.history = []
+        self.lock = Lock()
+        Thread(target=self.__load, daemon=True).start()
 
     def complete(self, prompt):
-        response =  self.gpt4all.chat_complete(
-            messages=prompt,
-            verbose=False,
-            streaming=False
-        )
-        text = response['choices'][0]['message']['content']
-        return text
+        return ''.join(self.stream(prompt))
+
+    def stream(self, prompt):
+        model = self.__model()
+        with self.lock:
+            text = self.__continue(prompt)
+            # generation stops once the callback returns False
+            cancelled = Event()
+            response = model.generate(text, streaming=True,
+                                      callback=lambda token_id, chunk: not cancelled.is_set(),
+                                      **self.parameters)
+            chunks = []
+            try:
+                for chunk in response:
+                    chunks.append(chunk)
+                    yield chunk
+            finally:
+                # let the generation end before the session is used again
+                cancelled.set()
+                for chunk in response:
+                    chunks.append(chunk)
+                self.history = prompt + [{'role': 'assistant', 'content': ''.join(chunks)}]
+
+    def __load(self):
+        start = time.monotonic()
+        kwargs = {'n_ctx': self.config['max_context']} if 'max_context' in self.config else {}
+        if 'device' in self.config:
+            kwargs['device'] = self.config['device']
+        try:
+            self.gpt4all = GPT4All(self.config['model'], **kwargs)
+        except Exception as ex:
+            self.load_error = ex
+            self.logger.error(f'Failed to load {self.config["model"]}: {ex}')
+        else:
+            self.logger.info(f'Loaded {self.config["model"]} in {time.monotonic() - start:.1f}s')
+        finally:
+            self.loaded.set()
+
+    def __model(self):
+        if not self.loaded.is_set():
+            self.logger.info(f'Waiting for {self.config["model"]} to load')
+            self.loaded.wait()
+        if self.load_error is not None:
+            raise self.load_error
+        return self.gpt4all
+
+    def __continue(self, prompt):
+        # the text to evaluate: the new messages (the user's, observations
+        # and recalled memories), if the prompt continues the session,
+        # otherwise those since the last response (after the system prompt),
+        # in a new session
+        n_history = len(self.history)
+        if self.session is not None and 0 < n_history < len(prompt) and \
+                all(self.__same(old, new) for old, new in zip(self.history, prompt)) and \
+                all(message['role'] != 'assistant' for message in prompt[n_history:]):
+            self.logger.info(f'Continuing session of {n_history} messages')
+            return '\n\n'.join(message['content'] for message in prompt[n_history:])
+
+        start = len(prompt)
+        while start > 1 and prompt[start - 1]['role'] != 'assistant':
+            start -= 1
+        self.__new_session(prompt[:start])
+        return '\n\n'.join(message['content'] for message in prompt[start:])
+
+    def __same(self, old, new):
+        # a response cut short (e.g. a hallucinated observation) left the
+        # discarded text in the session's context, so it cannot be continued
+        if old['role'] != new['role']:
+            return False
+        if old['role'] == 'assistant':
+            return old['content'].strip() == new['content'].strip()
+        return old['content'] == new['content']
+
+    def __new_session(self, messages):
+        if self.session is not None:
+            self.session.__exit__(None, None, None)
+        system = ''
+        if len(messages) > 0 and messages[0]['role'] == 'system':
+            system = self.system_template.format(messages[0]['content'])
+            messages = messages[1:]
+
+        # fold earlier turns into the system prompt, as the model would have
+        # seen them
+        pending = []
+        for message in messages:
+            if message['role'] == 'assistant':
+                if len(pending) > 0:
+                    system += self.prompt_template.format('\n\n'.join(pending))
+                system += message['content'] + '\n'
+                pending = []
+            else:
+                pending.append(message['content'])
+        self.logger.info(f'New session, with {len(messages)} earlier messages')
+        self.session = self.gpt4all.chat_session(system, self.prompt_template)
+        self.session.__enter__()
+        self.history = []
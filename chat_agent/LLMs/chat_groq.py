@@ -1,4 +1,4 @@
-from groq import Groq
+from groq import Groq, AsyncGroq
 try:
     from chat_agent.LLMs.chat_base import ChatBase
 except:
@@ -6,15 +6,77 @@ except:
 
 
 class ChatModel(ChatBase):
+    @property
+    def temperature(self):
+        # none is sent, so the model samples at its default
+        return None
+
     def __init__(self, config):
         super(ChatModel, self).__init__(config)
         self.client = Groq(
             api_key=self.api_key
         )
+        self.async_client = None
 
     def complete(self, prompt):
         result = self.client.chat.completions.create(
             model=self.config['model'],
-            messages = prompt
+            messages = prompt,
+            stop=self.config.get('stop')
         )
+        self.__record_usage(result.usage)
         return result.choices[0].message.content
+
+    def stream(self, prompt):
+        response = self.client.chat.completions.create(
+            model=self.config['model'],
+            messages = prompt,
+            stop=self.config.get('stop'),
+            stream=True
+        )
+        try:
+            for chunk in response:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.x_groq is not None:
+                    # reported in the last chunk
+                    self.__record_usage(chunk.x_groq.usage)
+        finally:
+            response.close()
+
+    async def acomplete(self, prompt):
+        result = await self.__async_client().chat.completions.create(
+            model=self.config['model'],
+            messages = prompt,
+            stop=self.config.get('stop')
+        )
+        self.__record_usage(result.usage)
+        return result.choices[0].message.content
+
+    async def astream(self, prompt):
+        response = await self.__async_client().chat.completions.create(
+            model=self.config['model'],
+            messages = prompt,
+            stop=self.config.get('stop'),
+            stream=True
+        )
+        try:
+            async for chunk in response:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.x_groq is not None:
+                    self.__record_usage(chunk.x_groq.usage)
+        finally:
+            await response.close()
+
+    def __record_usage(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        self.record_usage(usage.prompt_tokens, usage.completion_tokens,
+                          getattr(details, 'cached_tokens', None))
+
+    def __async_client(self):
+        if self.async_client is None:
+            self.async_client = AsyncGroq(api_key=self.api_key)
+        return self.async_client
@@ -1,4 +1,5 @@
-from openai import OpenAI
+import hashlib
+from openai import OpenAI, AsyncOpenAI
 try:
     from chat_agent.LLMs.chat_base import ChatBase
 except:
@@ -6,19 +7,88 @@ except:
 
 
 class ChatModel(ChatBase):
+    default_temperature = 0
+
     def __init__(self, config):
         super(ChatModel, self).__init__(config)
         self.client =  OpenAI(api_key=self.api_key)
+        self.async_client = None
 
     def complete(self, prompt):
         result = self.client.chat.completions.create(
             model=self.config['model'],
             messages = prompt,
-            temperature=self.config.get('temperature', 0),
-            top_p=self.config.get('top_p', 1),
-            n=self.config.get('n', 1),
-            presence_penalty=self.config.get('presence_penalty', 0),
-            frequency_penalty=self.config.get('frequency_penalty', 0),
-            max_tokens=self.config['max_tokens']
+            **self.__parameters(prompt)
         )
+        self.__record_usage(result.usage)
         return result.choices[0].message.content
+
+    def stream(self, prompt):
+        response = self.client.chat.completions.create(
+            model=self.config['model'],
+            messages = prompt,
+            stream=True,
+            stream_options={'include_usage': True},
+            **self.__parameters(prompt)
+        )
+        try:
+            for chunk in response:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                # reported in the last chunk
+                self.__record_usage(chunk.usage)
+        finally:
+            response.close()
+
+    async def acomplete(self, prompt):
+        result = await self.__async_client().chat.completions.create(
+            model=self.config['model'],
+            messages = prompt,
+            **self.__parameters(prompt)
+        )
+        self.__record_usage(result.usage)
+        return result.choices[0].message.content
+
+    async def astream(self, prompt):
+        response = await self.__async_client().chat.completions.create(
+            model=self.config['model'],
+            messages = prompt,
+            stream=True,
+            stream_options={'include_usage': True},
+            **self.__parameters(prompt)
+        )
+        try:
+            async for chunk in response:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                self.__record_usage(chunk.usage)
+        finally:
+            await response.close()
+
+    def __async_client(self):
+        if self.async_client is None:
+            self.async_client = AsyncOpenAI(api_key=self.api_key)
+        return self.async_client
+
+    def __record_usage(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        self.record_usage(usage.prompt_tokens, usage.completion_tokens,
+                          getattr(details, 'cached_tokens', None))
+
+    def __parameters(self, prompt):
+        parameters = {'temperature': self.temperature,
+                      'top_p': self.config.get('top_p', 1),
+                      'n': self.config.get('n', 1),
+                      'presence_penalty': self.config.get('presence_penalty', 0),
+                      'frequency_penalty': self.config.get('frequency_penalty', 0),
+                      'max_tokens': self.config['max_tokens']}
+        if 'stop' in self.config:
+            parameters['stop'] = self.config['stop']
+        if self.config.get('prompt_cache_key', True) and len(prompt) > 0:
+            # prompts with the same system prompt are routed to the same
+            # prompt cache
+            key = hashlib.blake2b(prompt[0]['content'].encode('utf-8'), digest_size=16).hexdigest()
+            parameters['extra_body'] = {'prompt_cache_key': key}
+        return parameters
@@ -6,6 +6,8 @@ except:
 
 
 class ChatModel(ChatBase):
+    default_temperature = 0
+
     def __init__(self, config):
         super(ChatModel, self).__init__(config)
         palm.configure(api_key=self.api_key)
@@ -16,7 +18,7 @@ class ChatModel(ChatBase):
             model=self.config['model'],
             context=prompt[0]['content'],
             messages=prompt[1:],
-            temperature=self.config.get('temperature', 0),
+            temperature=self.temperature,
             top_p=self.config.get('top_p', 1)
         )
         return response.last
@@ -0,0 +1,260 @@
+'''
+Routing chat model, which sends each call to the best of several backends,
+e.g. in chat_config.json
+
+    {"provider": "chat_router",
+     "backends": [{"provider": "chat_groq", "api_key": "GROQ_API_KEY", ...},
+                  {"provider": "chat_openai", "api_key": "OPENAI_API_KEY", ...}],
+     "retries": 2,
+     "hedge": true}
+
+Each backend is the configuration of another provider. Latencies (to the
+whole completion, and to the first chunk of a stream) and errors are kept
+over the last "window" calls to each backend, and each call goes to the
+healthy backend with the lowest median latency (allowing for its error
+rate). A backend which fails "max_failures" times in a row is left out for
+"cooldown" seconds.
+
+A failed call is retried, on the next best backend, up to "retries" times,
+after a jittered exponential backoff ("retry_delay"). With "hedge", once a
+backend has enough history, a call which has not answered by that
+backend's 95th percentile latency is sent again to the next best backend,
+and whichever answers first is used. A stream is only retried or hedged
+until its first chunk arrives.
+
+Unless given, "max_context" and "max_tokens" are the smallest of the
+backends', and the tokenizer is the first backend's.
+'''
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+try:
+    from chat_agent.LLMs.chat_base import ChatBase, load_chat_model, _usage
+except:
+    from LLMs.chat_base import ChatBase, load_chat_model, _usage
+
+
+class Backend:
+    def __init__(self, config, window=100, max_failures=3, cooldown=30, expected_latency=2.0):
+        self.name = config.get('name', f'{config["provider"]}:{config.get("model")}')
+        self.chat = load_chat_model(config)
+        self.latencies = {'complete': deque(maxlen=window), 'first_chunk': deque(maxlen=window)}
+        self.outcomes = deque(maxlen=window)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.expected_latency = config.get('expected_latency', expected_latency)
+        self.failures = 0
+        self.down_until = 0
+        self.lock = Lock()
+
+    def record(self, kind, latency):
+        with self.lock:
+            self.latencies[kind].append(latency)
+            self.outcomes.append(True)
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.outcomes.append(False)
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.down_until = time.monotonic() + self.cooldown
+
+    def percentile(self, kind, percent, min_samples=1):
+        with self.lock:
+            latencies = sorted(self.latencies[kind])
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    @property
+    def error_rate(self):
+        with self.lock:
+            return self.outcomes.count(False) / len(self.outcomes) if len(self.outcomes) > 0 else 0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+    def score(self, kind):
+        latency = self.percentile(kind, 50)
+        if latency is None:
+            latency = self.expected_latency
+        return latency * (1 + 4 * self.error_rate)
+
+    def stats(self):
+        return {'p50': self.percentile('complete', 50), 'p95': self.percentile('complete', 95),
+                'first_chunk_p50': self.percentile('first_chunk', 50),
+                'first_chunk_p95': self.percentile('first_chunk', 95),
+                'error_rate': self.error_rate, 'calls': len(self.outcomes), 'healthy': self.healthy}
+
+
+class ChatModel(ChatBase):
+    def __init__(self, config):
+        self.backends = [Backend(backend,
+                                 window=config.get('window', 100),
+                                 max_failures=config.get('max_failures', 3),
+                                 cooldown=config.get('cooldown', 30))
+                         for backend in config['backends']]
+        for name in ['max_context', 'max_tokens']:
+            if name not in config:
+                config[name] = min(backend.get(name, 4096) for backend in config['backends'])
+        if 'tokenizer' not in config:
+            config['tokenizer'] = config['backends'][0].get('tokenizer')
+        super(ChatModel, self).__init__(config)
+        self.retries = config.get('retries', 2)
+        self.retry_delay = config.get('retry_delay', 0.5)
+        self.hedge = config.get('hedge', True)
+        self.min_samples = config.get('min_samples', 10)
+        self.executor = ThreadPoolExecutor(config.get('max_workers', 16))
+        self.exclusive = any(backend.chat.exclusive for backend in self.backends)
+
+    @property
+    def backend_stats(self):
+        return {backend.name: backend.stats() for backend in self.backends}
+
+    def complete(self, prompt):
+        backend, (text, usage) = self.__with_retries('complete', self.__complete_on, prompt)
+        self.record_usage(**usage)
+        return text
+
+    def stream(self, prompt):
+        backend, (stream, chunk) = self.__with_retries('first_chunk', self.__start_stream, prompt)
+        start = time.monotonic()
+        try:
+            if chunk is not None:
+                yield chunk
+            # the rest of the stream reports usage (if it does) in this context
+            for chunk in stream:
+                yield chunk
+        except GeneratorExit:
+            raise
+        except Exception:
+            backend.record_failure()
+            raise
+        finally:
+            stream.close()
+        backend.record('complete', backend.percentile('first_chunk', 50) + time.monotonic() - start)
+
+    def __ranked(self, kind, exclude):
+        # healthy backends first, fastest first; those which already failed
+        # this call last
+        return sorted(self.backends, key=lambda backend: (backend in exclude, not backend.healthy,
+                                                          backend.score(kind)))
+
+    def __with_retries(self, kind, call, prompt):
+        failed = []
+        for attempt in range(self.retries + 1):
+            backends = self.__ranked(kind, failed)
+            try:
+                return self.__hedged(kind, call, backends, prompt)
+            except Exception as ex:
+                failed.append(backends[0])
+                self.logger.error(f'{backends[0].name} failed: {ex}')
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def __hedged(self, kind, call, backends, prompt):
+        # returns (backend, result) of the first call to succeed
+        primary = backends[0]
+        futures = {self.executor.submit(call, primary, prompt): primary}
+        deadline = primary.percentile(kind, 95, self.min_samples) if self.hedge else None
+        if deadline is not None:
+            done, _ = wait(futures, timeout=deadline)
+            if len(done) == 0:
+                hedge = backends[1] if len(backends) > 1 else primary
+                self.logger.info(f'{primary.name} slower than {deadline:.2f}s, hedging on {hedge.name}')
+                futures[self.executor.submit(call, hedge, prompt)] = hedge
+
+        pending = set(futures)
+        error = None
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.add_done_callback(self.__discard)
+                    return futures[future], future.result()
+                error = future.exception()
+        raise error
+
+    def __complete_on(self, backend, prompt):
+        _usage.set({})
+        start = time.monotonic()
+        try:
+            text = backend.chat.complete(prompt)
+        except Exception:
+            backend.record_failure()
+            raise
+        backend.record('complete', time.monotonic() - start)
+        return text, dict(backend.chat.usage)
+
+    def __start_stream(self, backend, prompt):
+        start = time.monotonic()
+        stream = backend.chat.stream(prompt)
+        try:
+            chunk = next(stream, None)
+        except Exception:
+            backend.record_failure()
+            stream.close()
+            raise
+        backend.record('first_chunk', time.monotonic() - start)
+        return stream, chunk
+
+    def __discard(self, future):
+        # close the stream of a hedged call which lost the race
+        if future.exception() is None and isinstance(future.result(), tuple) and \
+                hasattr(future.result()[0], 'close'):
+            future.result()[0].close()
+
+
+def test():
+    import statistics
+
+    def backend(name, delay, error_rate=0):
+        return {'provider': 'chat_fake', 'name': name, 'model': 'fake',
+                'tokenizer': {'type': 'estimate'}, 'first_token_delay': delay,
+                'token_delay': 0, 'words_per_chunk': 100, 'error_rate': error_rate,
+                'expected_latency': 0.1}
+
+    prompt = [{'role': 'user', 'content': 'hello'}]
+
+    # calls settle on the faster backend
+    router = ChatModel({'provider': 'chat_router', 'retry_delay': 0.01, 'min_samples': 5,
+                        'backends': [backend('slow', 0.3), backend('fast', 0.05)]})
+    for _ in range(10):
+        router(prompt)
+    stats = router.backend_stats
+    assert stats['fast']['calls'] >= 9 and stats['slow']['calls'] <= 1, stats
+
+    # failures are retried on the other backend, and an unreliable backend
+    # is left out
+    router = ChatModel({'provider': 'chat_router', 'retry_delay': 0.01, 'cooldown': 60,
+                        'max_failures': 1,
+                        'backends': [backend('flaky', 0.01, error_rate=1), backend('steady', 0.05)]})
+    for _ in range(10):
+        assert 'Final Answer' in router(prompt)
+        assert 'Final Answer' in ''.join(router(prompt, stream=True))
+    stats = router.backend_stats
+    assert not stats['flaky']['healthy'] and stats['flaky']['calls'] <= 3, stats
+
+    # a backend with a slow tail is hedged on the other
+    router = ChatModel({'provider': 'chat_router', 'retry_delay': 0.01, 'min_samples': 5,
+                        'backends': [backend('tail', 0.05), backend('spare', 0.1)]})
+    for _ in range(10):
+        router(prompt)
+    router.backends[0].chat.first_token_delay = 2
+    latencies = []
+    for _ in range(5):
+        start = time.monotonic()
+        router(prompt)
+        latencies.append(time.monotonic() - start)
+    assert max(latencies) < 0.5, latencies
+    print(f'Router OK: hedged latency p50 {statistics.median(latencies) * 1000:.0f} ms; '
+          f'{router.backend_stats}')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,79 @@
+'''
+Cache of completions, for ChatBase.
+
+Completions are stored in SQLite, keyed by a hash of the messages and the
+model and its sampling parameters. Entries expire after ttl seconds, and at
+most max_entries are kept, the least recently used going first.
+'''
+import hashlib
+import json
+import sqlite3
+import time
+from threading import Lock
+
+# configuration entries which change what the model would say
+KEY_PARAMETERS = ['provider', 'model', 'temperature', 'top_p', 'top_k', 'n', 'presence_penalty',
+                  'frequency_penalty', 'max_tokens', 'stop', 'candidate_count']
+
+
+class CompletionCache:
+    def __init__(self, path, ttl=86400, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = Lock()
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY, completion TEXT, prompt_tokens INTEGER,
+                completion_tokens INTEGER, created_at REAL, last_access REAL)''')
+        self.conn.commit()
+
+    def key(self, prompt, config):
+        messages = [{'role': message.get('role'), 'content': message.get('content')}
+                    for message in prompt]
+        parameters = {name: config[name] for name in KEY_PARAMETERS if name in config}
+        canonical = json.dumps({'messages': messages, 'parameters': parameters},
+                               sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.blake2b(canonical.encode('utf-8'), digest_size=20).hexdigest()
+
+    def get(self, key):
+        '''
+        Returns the completion and its usage, or None
+        '''
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT completion, prompt_tokens, completion_tokens, created_at '
+                'FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None or time.time() - row[3] >= self.ttl:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.conn.execute('UPDATE completions SET last_access = ? WHERE key = ?',
+                              (time.time(), key))
+            self.conn.commit()
+        completion, prompt_tokens, completion_tokens, _ = row
+        return completion, {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}
+
+    def put(self, key, completion, usage):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?)',
+                (key, completion, usage.get('prompt_tokens'), usage.get('completion_tokens'),
+                 now, now))
+            self.conn.execute('DELETE FROM completions WHERE created_at <= ?', (now - self.ttl,))
+            n_entries = self.conn.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+            if n_entries > self.max_entries:
+                self.conn.execute(
+                    'DELETE FROM completions WHERE key IN '
+                    '(SELECT key FROM completions ORDER BY last_access LIMIT ?)',
+                    (n_entries - self.max_entries,))
+            self.conn.commit()
+
+    @property
+    def hit_ratio(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total > 0 else 0
@@ -0,0 +1,148 @@
+'''
+Asyncio version of the chat agent.
+
+Calls to the LLM and to tools are coroutines, so many conversations can be
+served from one event loop without a thread per turn or per tool. Tools
+are given timeouts with asyncio.wait_for (and cancelled when they run
+out), and when the model gives several independent actions in a response
+(with "multi_action" in chat_config.json) they are run concurrently.
+
+Messages for the user are put on an asyncio.Queue as (done, text, metadata),
+as with ChatAgent.
+'''
+import asyncio
+
+try:
+    from chat_agent.chatagent import ChatAgent, next_sentences
+    from chat_agent.react_parser import ReActParser
+except:
+    from chatagent import ChatAgent, next_sentences
+    from react_parser import ReActParser
+
+
+class AsyncChatAgent(ChatAgent):
+    async def __call__(self, text, message_queue):
+        # log user input
+        self.logger.info(f'User\'s message: {text}')
+        self.chat_logger.log_message(f'Human: {text}')
+
+        # memories are recalled, in a worker thread, while the message is
+        # added
+        recall = None
+        if self.resources.recall_executor is not None:
+            recall = asyncio.get_running_loop().run_in_executor(
+                self.resources.recall_executor, self.resources.recall, text, self.session_id,
+                self.context.memories)
+
+        # loop to perform actions scheduled by the LLM
+        self.context.add(role='user', text=text)
+        if recall is not None:
+            self.context.add_memories(*await recall)
+        metadata = None
+        while True:
+            prompt = self.context.get_prompt()
+
+            # prompt the LLM, parsing the response as it is generated
+            parser = ReActParser(multi_action=self.multi_action)
+            sent = await self.__stream_output(prompt, parser, message_queue)
+            output = parser.text
+            self.logger.info(f'AI: {output}')
+
+            usage = self.chat.usage
+            n_tokens = None if parser.action_complete else usage.get('completion_tokens')
+            self.context.add(role='assistant', text=output, n_tokens=n_tokens)
+            if 'prompt_tokens' in usage:
+                if 'cached_tokens' in usage:
+                    self.logger.info(f'Prompt tokens: {usage["cached_tokens"]} cached, '
+                                     f'{usage["prompt_tokens"] - usage["cached_tokens"]} uncached')
+                self.context.calibrate(usage['prompt_tokens'])
+
+            if not parser.action_complete:
+                break
+
+            # run the actions concurrently, adding each observation in
+            # the order they were given
+            responses = await self.__run_tools(parser.actions, message_queue)
+            for result, tool_metadata in responses:
+                self.context.add_observation(str(result))
+                if tool_metadata is not None:
+                    metadata = tool_metadata
+
+        # log final result and push (whatever was not yet streamed of it)
+        # to calling task
+        _, answer, _ = parser.result()
+        self.chat_logger.log_message(f'AI: {answer}')
+        self.resources.remember(text, answer, self.session_id)
+        if sent > 0:
+            answer = parser.answer[sent:].strip()
+        await message_queue.put((True, answer, metadata))
+
+    async def __stream_output(self, prompt, parser, message_queue):
+        # consume the response as it is generated, as in ChatAgent
+        sent = 0
+        thought_sent = False
+        if self.stream:
+            response = await self.chat.acall(prompt, stream=True)
+        else:
+            response = self.__single_chunk(await self.chat.acall(prompt))
+        try:
+            async for chunk in response:
+                parser.feed(chunk)
+                if parser.thought is not None and not thought_sent:
+                    self.chat_logger.log_message(f'AI: {parser.thought}')
+                    await message_queue.put((False, parser.thought, None))
+                    thought_sent = True
+                if parser.action_complete:
+                    break
+                if self.stream:
+                    sentences, sent = next_sentences(parser.answer, sent)
+                    if sentences is not None:
+                        await message_queue.put((False, sentences, None))
+        finally:
+            await response.aclose()
+        parser.finish()
+        if parser.thought is not None and not thought_sent:
+            self.chat_logger.log_message(f'AI: {parser.thought}')
+            await message_queue.put((False, parser.thought, None))
+        return sent
+
+    async def __single_chunk(self, output):
+        yield output
+
+    async def __run_tools(self, actions, message_queue):
+        # keep the user apprised while tools which take a while are running
+        waits = [self.tools[tool]['wait'] for tool, _ in actions
+                 if tool in self.tools and self.tools[tool]['wait'] > 0]
+        heartbeat = None
+        if len(waits) > 0:
+            await message_queue.put((False, "Thinking...", None))
+            heartbeat = asyncio.create_task(self.__heartbeat(min(waits), message_queue))
+        try:
+            return await asyncio.gather(*[self.__run_tool(tool, tool_input, message_queue)
+                                          for tool, tool_input in actions])
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+
+    async def __run_tool(self, tool, tool_input, message_queue, max_iter=10):
+        if tool not in self.tools:
+            return (f'There is no tool called "{tool}". Try again using a tool '
+                    'listed or give final answer.', None)
+
+        # time out after the tool's timeout, or (as ChatAgent does) max_iter
+        # of its waits
+        timeout = self.tools[tool]['timeout']
+        if timeout is None and self.tools[tool]['wait'] > 0:
+            timeout = self.tools[tool]['wait'] * max_iter
+        try:
+            return await asyncio.wait_for(self.tools[tool]['object'].arun(tool_input),
+                                          timeout=timeout)
+        except asyncio.TimeoutError:
+            self.logger.error(f'The {tool} tool timed out')
+            await message_queue.put((False, "Tool timedout", None))
+            return (f'The {tool} tool did not respond in time.', None)
+
+    async def __heartbeat(self, wait, message_queue):
+        while True:
+            await asyncio.sleep(wait)
+            await message_queue.put((False, "Thinking...", None))
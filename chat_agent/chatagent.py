@@ -1,105 +1,254 @@
 import os
+import atexit
 import logging
 import json
 import re
-import importlib
 import datetime
+import uuid
 from threading import Thread
 from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from chat_agent.memory.context import Context
-    from chat_agent.display_code import CodeDisplay
+    from chat_agent.memory.summary import RollingSummary
+    from chat_agent.LLMs.chat_base import load_chat_model
+    from chat_agent.react_parser import ReActParser
+    from chat_agent.chat_logging import setup_logging, ChatLogging
+    from chat_agent.tools.lazy_tool import LazyTool
+    from chat_agent.startup import timed
 except:
     from memory.context import Context
-    from display_code import CodeDisplay
+    from memory.summary import RollingSummary
+    from LLMs.chat_base import load_chat_model
+    from react_parser import ReActParser
+    from chat_logging import setup_logging, ChatLogging
+    from tools.lazy_tool import LazyTool
+    from startup import timed
 
 
-class ChatAgent:
-    debug = True
+class AgentResources:
+    '''
+    What is loaded once and may be shared by any number of agents (sessions):
+    the chat model, the tools, and the system prompt. Files are read from
+    base_dir; config and tools may instead be given directly.
+    '''
+    def __init__(self, base_dir=None, config=None, tools=None):
+        if base_dir is None:
+            base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.base_dir = base_dir
+        self.logger = logging.getLogger('chat_log')
 
-    def __init__(self, verbose=False):
-        self.verbose = verbose
+        # setup chat model
+        if config is None:
+            config_path = os.path.join(self.base_dir, 'chat_config.json')
+            with open(config_path, 'r') as FILE:
+                config = json.load(FILE)
+        self.config = config
+        with timed(f'chat model ({config["provider"]})'):
+            self.chat = load_chat_model(config)
 
-        # setup logging
-        now = datetime.datetime.now()
-        logfile = f'chatlog-{now.strftime("%m.%d.%Y-%H.%M.%S")}.log'
-        logpath = os.path.join('chat_agent', 'logs', logfile)
-        logging.basicConfig(handlers=[logging.FileHandler(logpath, 'w', 'utf-8')], 
-                            level=logging.INFO, 
-                            format='%(asctime)s %(message)s')
-        self.logger = logging.getLogger('chat_log')
+        # conversation evicted from the contexts is summarized in the
+        # background, by workers shared by all sessions. By default not with
+        # a model which runs one call at a time (e.g. a local model), unless
+        # given a model of its own ("summary_model", a full configuration)
+        self.summary_chat = self.chat
+        if config.get('summary_model'):
+            with timed(f'summary model ({config["summary_model"]["provider"]})'):
+                self.summary_chat = load_chat_model(config['summary_model'])
+        self.summary_executor = None
+        shared = self.summary_chat is self.chat and self.chat.exclusive
+        if config.get('summarize_history', not shared):
+            if shared:
+                self.logger.warning('Summaries of the conversation will hold up the turns of '
+                                    f'{config["provider"]}; consider a "summary_model"')
+            self.summary_executor = ThreadPoolExecutor(config.get('summary_workers', 2))
 
-        # setup chat logging (transcript)
-        self.chat_logger = ChatLogging()
+        # opt in long-term memory of past conversations, e.g.
+        # "long_term_memory": {"embeddings": {"type": "hashing"}, "k": 5, "max_tokens": 512}
+        self.long_term_memory = None
+        self.recall_executor = None
+        memory_config = config.get('long_term_memory')
+        if memory_config:
+            with timed('long-term memory'):
+                self.long_term_memory = self.__load_long_term_memory(
+                    memory_config if isinstance(memory_config, dict) else {})
+            self.recall_executor = ThreadPoolExecutor(config.get('recall_workers', 2))
 
-        # setup chat model
-        config_path = os.path.join('chat_agent', 'chat_config.json')
-        with open(config_path, 'r') as FILE:
-            config = json.load(FILE)
-        try:
-            provider = importlib.import_module('chat_agent.LLMs.' + config['provider'].strip())
-        except:
-            provider = importlib.import_module('LLMs.' + config['provider'].strip())
-        self.chat = provider.ChatModel(config)
-        
-        # setup tools
-        tools_path = os.path.join('chat_agent', 'tools.json')
-        with open(tools_path, 'r') as FILE:
-           tools = json.load(FILE)
+        # setup tools. Each is imported and constructed on first use, unless
+        # warmed up before then in the background
+        if tools is None:
+            tools_path = os.path.join(self.base_dir, 'tools.json')
+            with open(tools_path, 'r') as FILE:
+               tools = json.load(FILE)
 
         self.tools = {}
         tool_descriptions = []
         for tool in tools:
-            try:
-                module = importlib.import_module('chat_agent.tools.' +  tool['module'])
-            except:
-                module = importlib.import_module('tools.' +  tool['module'])
-            object = module.Tool(tool['name'], self.chat, **tool['parameters'])
-            self.tools[tool['name']] = {"object": object, "wait": tool['wait']}
+            object = LazyTool(tool['name'], tool['module'], self.chat, **tool['parameters'])
+            self.tools[tool['name']] = {"object": object, "wait": tool['wait'],
+                                        "timeout": tool.get('timeout')}
             tool_descriptions.append(f'{tool["name"]}: {tool["description"]}')
+        if config.get('warm_tools', True):
+            Thread(target=self.warm_up, name='tool-warm-up', daemon=True).start()
 
         # setup sys prompt
-        prompt_path = os.path.join('chat_agent', 'sys_prompt.txt')
+        prompt_path = os.path.join(self.base_dir, config.get('sys_prompt', 'sys_prompt.txt'))
         with open(prompt_path, 'r') as FILE:
            sys_prompt = FILE.read()
 
         # get user profile
-        profile_path = os.path.join('chat_agent', 'user_profile.txt')
+        profile_path = os.path.join(self.base_dir, 'user_profile.txt')
         with open(profile_path, 'r') as FILE:
             user_profile = FILE.read()
 
-        sys_prompt = sys_prompt.format(
+        self.sys_prompt = sys_prompt.format(
                 today=datetime.date.today(),
                 user_profile=user_profile,
                 tool_description='\n'.join(tool_descriptions),
                 tool_names=', '.join(list(self.tools.keys())))
-        
+
+    def warm_up(self):
+        '''
+        Load the tools not loaded yet
+        '''
+        for tool in self.tools.values():
+            tool['object'].load()
+
+    def new_context(self):
+        '''
+        Create an empty context buffer for a conversation
+        '''
+        return Context(self.sys_prompt,
+                       num_response_tokens=self.config['max_tokens'],
+                       max_context_tokens=self.config['max_context'],
+                       max_observation_tokens=self.config.get('max_observation_tokens'),
+                       observation_truncation=self.config.get('observation_truncation', 'head'),
+                       tokenizer=self.chat.tokenizer,
+                       compact_to=self.config.get('compact_to', 0.5),
+                       summary=self.__new_summary())
+
+    def recall(self, text, session_id, exclude=()):
+        '''
+        Message of memories of earlier conversations relevant to the user's
+        message (other than those in exclude), or None (also if long-term
+        memory is not enabled), and the memories
+        '''
+        if self.long_term_memory is None:
+            return None, []
+        memory_config = self.config['long_term_memory']
+        memory_config = memory_config if isinstance(memory_config, dict) else {}
+        try:
+            memories = self.long_term_memory.recall(
+                text, k=memory_config.get('k', 5), max_tokens=memory_config.get('max_tokens', 512),
+                exclude_session=session_id, exclude=exclude)
+        except Exception as ex:
+            self.logger.error(f'Failed to recall memories: {ex}')
+            return None, []
+        self.logger.info(f'Recalled {len(memories)} memories')
+        return self.long_term_memory.message(memories), memories
+
+    def remember(self, text, answer, session_id):
+        '''
+        Keep a completed turn in long-term memory (in the background)
+        '''
+        if self.long_term_memory is not None:
+            self.long_term_memory.remember(f'User: {text}\nAI: {answer}', session=session_id)
+
+    def __load_long_term_memory(self, memory_config):
+        try:
+            from chat_agent.memory.long_term import LongTermMemory
+            from chat_agent.tools.embeddings import CachedEmbeddings, get_embeddings
+        except:
+            from memory.long_term import LongTermMemory
+            from tools.embeddings import CachedEmbeddings, get_embeddings
+        path = memory_config.get('path', os.path.join(self.base_dir, 'long_term_memory'))
+        os.makedirs(path, exist_ok=True)
+        embeddings = CachedEmbeddings(get_embeddings(memory_config.get('embeddings')),
+                                      os.path.join(path, 'embeddings.sqlite'))
+        memory = LongTermMemory(path, embeddings, self.chat.tokenizer)
+        atexit.register(memory.close)
+        return memory
+
+    def __new_summary(self):
+        if self.summary_executor is None:
+            return None
+        return RollingSummary(self.summary_chat, self.summary_executor,
+                              max_tokens=self.config.get('max_summary_tokens', 256))
+
+
+class ChatAgent:
+    debug = True
+
+    def __init__(self, verbose=False, resources=None, chat_logger=None):
+        self.verbose = verbose
+
+        # setup logging
+        setup_logging()
+        self.logger = logging.getLogger('chat_log')
+
+        # chat model, tools and sys prompt may be shared with other agents
+        if resources is None:
+            resources = AgentResources()
+        self.resources = resources
+
+        # setup chat logging (transcript)
+        self.chat_logger = chat_logger if chat_logger is not None else \
+            ChatLogging(**resources.config.get('transcript', {}))
+        self.chat = resources.chat
+        self.tools = resources.tools
+        self.stream = resources.config.get('stream', True)
+        self.multi_action = resources.config.get('multi_action', False)
+
         # context buffer
-        self.context = Context(sys_prompt, 
-                               num_response_tokens=config['max_tokens'],
-                               max_context_tokens=config['max_context'])
+        self.context = resources.new_context()
+        self.session_id = uuid.uuid4().hex
 
     def __call__(self, text, message_queue):
         # log user input
         self.logger.info(f'User\'s message: {text}')
         self.chat_logger.log_message(f'Human: {text}')
 
-        # loop to perform actions scheduled by the LLM
+        # loop to perform actions scheduled by the LLM. The user's message,
+        # each response and each observation are added to the context once,
+        # as the scratchpad for the task
+        # memories are recalled while the message is added
+        recall = None
+        if self.resources.recall_executor is not None:
+            recall = self.resources.recall_executor.submit(
+                self.resources.recall, text, self.session_id, self.context.memories)
+        self.context.add(role='user', text=text)
+        if recall is not None:
+            self.context.add_memories(*recall.result())
         done = False
         while not done:
-            # get complete user prompt
-            self.context.add(role='user', text=text)
             prompt = self.context.get_prompt()
 
-            # prompt the LLM
-            output = self.chat(prompt)
+            # prompt the LLM, parsing the response as it is generated
+            parser = ReActParser(multi_action=self.multi_action)
+            if self.stream:
+                sent = self.__stream_output(prompt, parser, message_queue)
+            else:
+                sent = 0
+                parser.feed(self.chat(prompt))
+                parser.finish()
+            output = parser.text
             self.logger.info(f'AI: {output}')
-            self.context.add(role='assistant', text=output)
 
-            # parse response from the LLM
-            tool, tool_input, thought = self.__parse(output)
-            if thought is not None:
+            # use token counts reported by the provider, where available.
+            # The completion tokens are only those of the output kept if the
+            # generation was not cut off
+            usage = self.chat.usage
+            n_tokens = None if parser.action_complete else usage.get('completion_tokens')
+            self.context.add(role='assistant', text=output, n_tokens=n_tokens)
+            if 'prompt_tokens' in usage:
+                if 'cached_tokens' in usage:
+                    self.logger.info(f'Prompt tokens: {usage["cached_tokens"]} cached, '
+                                     f'{usage["prompt_tokens"] - usage["cached_tokens"]} uncached')
+                self.context.calibrate(usage['prompt_tokens'])
+
+            tool, tool_input, thought = parser.result()
+            if thought is not None and not self.stream:
                 self.chat_logger.log_message(f'AI: {thought}')
                 message_queue.put((False, thought, None))
 
@@ -108,28 +257,66 @@ class ChatAgent:
                 done = True
                 metadata = None
                 continue
-            if tool not in list(self.tools.keys()):
-                text = f'There is no tool called "{tool}". Try again using a tool listed \
-                         or give final answer.'
-                continue
-            
-            # if wait is 0, run directly and block for response. Otherwise, run
-            # in new thread so we can track it's progress
-            if self.tools[tool]['wait'] > 0:
-                response = self.__wait_for_tool(tool, tool_input, message_queue)
-            else:
-                response = self.tools[tool]['object'](tool_input, None)
-                if response is None:
-                    # we're in trouble
-                    raise TimeoutError(f'The {tool} tool did not respond')
 
-            result, metadata = response
-            text = f'{text}\n\nObservation: {result}'
+            # run each action in turn (several with "multi_action"), adding
+            # each observation in the order they were given
+            for tool, tool_input in parser.actions:
+                if tool not in list(self.tools.keys()):
+                    self.context.add(role='user',
+                                     text=f'There is no tool called "{tool}". Try again using a tool '
+                                          'listed or give final answer.')
+                    continue
+
+                # if wait is 0, run directly and block for response. Otherwise, run
+                # in new thread so we can track it's progress
+                if self.tools[tool]['wait'] > 0:
+                    response = self.__wait_for_tool(tool, tool_input, message_queue)
+                else:
+                    response = self.tools[tool]['object'](tool_input, None)
+                    if response is None:
+                        # we're in trouble
+                        raise TimeoutError(f'The {tool} tool did not respond')
+
+                result, metadata = response
+                self.context.add_observation(str(result))
                         
-        # log final result and push to calling thread
+        # log final result and push (whatever was not yet streamed of it)
+        # to calling thread
         self.chat_logger.log_message(f'AI: {tool_input}')
+        self.resources.remember(text, tool_input, self.session_id)
+        if sent > 0:
+            tool_input = parser.answer[sent:].strip()
         message_queue.put((True, tool_input, metadata))
 
+    def __stream_output(self, prompt, parser, message_queue):
+        # consume the response as it is generated. Push the thought as soon
+        # as it is complete, and once a final answer has begun, push each
+        # completed sentence rather than waiting for the whole response. As
+        # soon as an action and its input are complete, cancel the rest of
+        # the generation.
+        sent = 0
+        thought_sent = False
+        response = self.chat(prompt, stream=True)
+        try:
+            for chunk in response:
+                parser.feed(chunk)
+                if parser.thought is not None and not thought_sent:
+                    self.chat_logger.log_message(f'AI: {parser.thought}')
+                    message_queue.put((False, parser.thought, None))
+                    thought_sent = True
+                if parser.action_complete:
+                    break
+                sentences, sent = next_sentences(parser.answer, sent)
+                if sentences is not None:
+                    message_queue.put((False, sentences, None))
+        finally:
+            response.close()
+        parser.finish()
+        if parser.thought is not None and not thought_sent:
+            self.chat_logger.log_message(f'AI: {parser.thought}')
+            message_queue.put((False, parser.thought, None))
+        return sent
+
     def __wait_for_tool(self, tool, tool_input, message_queue, max_iter=10):
         # setup queue to receive response from tool
         tool_queue = Queue()
@@ -157,39 +344,21 @@ class ChatAgent:
                 tool_done = True
         tool_thread.join()
         return response
-
-    def __parse(self, generated: str):
-        # check for thoughts to record
-        regex = r"Thought: [\[]?(.*?)[\]]?[\n]"
-        match = re.search(regex, generated, re.DOTALL)
-        if match:
-            thought_output = f'{match.group(0)}'
-        else:
-            thought_output = None
-
-        # is final answer?
-        if 'Final Answer:' in generated:
-            return "Final Answer", generated.split('Final Answer:')[-1].strip(), thought_output
-
-        # find action
-        regex = r"Action: [\[]?(.*?)[\]]?[\n]*Action Input:[\s]*(.*)"
-        match = re.search(regex, generated, re.DOTALL)
-        if not match:
-            tool = 'Final Answer'
-            tool_input = generated
-        else:
-            tool = match.group(1).strip()
-            tool_input = match.group(2)
-
-        return tool, tool_input.strip(" ").strip('"'), thought_output
         
 
-class ChatLogging:
-    def __init__(self):
-        now = datetime.datetime.now()
-        chat_file = f'chat-{now.strftime("%m.%d.%Y-%H.%M.%S")}.log'
-        self.chat_path = os.path.join('chat_agent', 'chats', chat_file)
+def next_sentences(answer, sent):
+    '''
+    Find the completed sentences of an answer (being generated) following
+    what has been sent so far, not splitting code blocks (so they can still
+    be filtered out for display)
 
-    def log_message(self, message):
-        with open(self.chat_path, 'a', encoding="utf-8") as FILE:
-            FILE.write(f'{message}\n\n')        
+    Returns the sentences (or None), and the new position in the answer
+    '''
+    pending = answer[sent:]
+    end = None
+    for match in re.finditer(r'[.!?:]\s+|\n+', pending):
+        if answer[:sent + match.end()].count('```') % 2 == 0:
+            end = match.end()
+    if end is None:
+        return None, sent
+    return pending[:end].strip(), sent + end
@@ -7,66 +7,207 @@ PRETEXT: a description of the chatbot
 CONTEXT: the current conversation
 
 The maximum length of the buffer is 4096 tokens. We will deduct the
-length of the pretext, and the maximum tokens for a response. When
-queried for the current context, will will return messages from
-the most recent until fitting within the difference.
+length of the pretext, and the maximum tokens for a response. The
+conversation is kept in a deque along with a running count of its
+tokens. The prompt is cached between changes.
+
+Messages are only ever appended, until the conversation no longer fits
+within the difference (the high-water mark). The oldest messages are then
+evicted in one block (and handed to the on_evict callback, if any, to be
+archived) until the conversation is down to the compact_to fraction of
+it (the low-water mark), and so that it does not start with a response.
+Between compactions each prompt extends the one before, so providers
+which cache prompt prefixes can reuse all but the newest messages, where
+evicting a message or two on every turn would shift the whole prompt each
+time. compact_to=1 evicts just enough for the new message to fit.
+
+With a summary (see summary.py), evicted messages are summarized in the
+background rather than forgotten, and the latest summary follows the
+pretext, counted within the limit.
+
+Memories recalled from earlier conversations (see long_term.py) for a
+turn go just before the user's message, and stay in the conversation like
+any other message (so later prompts still extend earlier ones); memories
+still in the context are not recalled again.
+
+Observations (results of actions) are each added once as a message of
+their own, optionally truncated, so prompts grow linearly with the number
+of steps of a task.
+
+Tokens are counted with the provider's tokenizer (see tokenizers.py).
+When the provider reports the actual number of prompt tokens used, the
+context is calibrated against it, so that trimming is neither too
+aggressive nor too lax.
 
 '''
-import tiktoken as tt
+from collections import deque
+try:
+    from chat_agent.memory.tokenizers import get_tokenizer
+except:
+    from memory.tokenizers import get_tokenizer
 
 
 class Context:
-    def __init__(self, pretext, num_response_tokens=128, max_context_tokens=4096):
+    def __init__(self, pretext, num_response_tokens=128, max_context_tokens=4096,
+                 on_evict=None, max_observation_tokens=None, observation_truncation='head',
+                 tokenizer=None, compact_to=0.5, summary=None):
         self.__max_context_tokens = max_context_tokens
         self.__num_response_tokens = num_response_tokens
-        self.__context = []
+        self.__max_observation_tokens = max_observation_tokens
+        self.__observation_truncation = observation_truncation
+        self.__compact_to = compact_to
+        self.__context = deque()
+        self.__n_tokens = 0
         self.__pretext = []
+        self.__prompt = None
+        self.__prompt_tokens = None
+        self.__scale = 1.0
+        self.__on_evict = on_evict
+        self.__summary = summary
+        self.__summary_version = None
 
-        # get system prompt (pretext)
-        self.__encoder = tt.get_encoding('p50k_base')
-        self.__num_pretext_tokens = len(self.__encoder.encode(pretext))
+        # get system prompt (pretext). Its tokens are counted on first use,
+        # so the tokenizer is not loaded at startup
+        self.__tokenizer = tokenizer if tokenizer is not None else get_tokenizer()
+        self.__num_pretext_tokens = None
         self.__pretext.append({'role': 'system', 'content': pretext})
-        self.__max_conv = (self.__max_context_tokens - 
-                           (self.__num_pretext_tokens + self.__num_response_tokens))
+
+    def __len__(self):
+        return len(self.__context)
+
+    @property
+    def n_tokens(self):
+        '''
+        Number of tokens in the conversation currently in the context
+        '''
+        return self.__n_tokens
+
+    @property
+    def memories(self):
+        '''
+        Texts of the memories recalled which are still in the context
+        '''
+        return {memory for item in self.__context for memory in item.get('memories', [])}
+
+    @property
+    def num_pretext_tokens(self):
+        if self.__num_pretext_tokens is None:
+            self.__num_pretext_tokens = self.__tokenizer.count(self.__pretext[0]['content'])
+        return self.__num_pretext_tokens
 
     def get_prompt(self):
         '''
-        Manage the context capacity as well as returning the 
-        combined pretext and context
+        Return the combined pretext and context. The returned list is
+        shared until the context next changes, so should not be modified.
         '''
-        # encode the context, and truncate early portion as needed
-        # to keep within limit
-        n_tokens = 0
-        context = []
-        for indx in range(len(self.__context) - 1, -1, -1):
-            n_tokens += self.__context[indx]['n_tokens']
-            if n_tokens >= self.__max_conv:
-                break
-            context.append(self.__context[indx]['message'])
-
-        # return concatenated pretext and context
-        return self.__pretext + context[::-1]
+        if self.__summary is not None and self.__summary.version != self.__summary_version:
+            self.__summary_version = self.__summary.version
+            self.__prompt = None
+        if self.__prompt is None:
+            memory = [] if self.__summary is None or self.__summary.message is None \
+                else [self.__summary.message]
+            self.__prompt = self.__pretext + memory + [item['message'] for item in self.__context]
+        self.__prompt_tokens = self.num_pretext_tokens + self.__num_summary_tokens + \
+            self.__n_tokens
+        return self.__prompt
 
     def add(self, role, text, provider='openai', n_tokens=None):
         '''
-        Add token count, role, and content to the context
+        Add token count, role, and content to the context, evicting
+        the earliest messages as needed to keep within limit
 
-        Input: new text
+        Input: new text, and number of tokens if known (e.g. reported
+        by the provider)
         '''
         if len(text) > 0:
-            # if not passed, estimate number of tokens
+            # if not passed, count number of tokens
             if n_tokens is None or n_tokens == 0:
-                n_tokens = len(self.__encoder.encode(text))
+                n_tokens = self.__tokenizer.count(text)
 
             # assemble message and add to appropriate list
             if provider in ['openai', 'gpt4all']:
-                message = {'n_tokens': n_tokens, 
+                message = {'n_tokens': n_tokens,
                         'message': {'role': role, 'content': text}}
             elif provider == 'PaLM':
-                message = {'n_tokens': n_tokens, 
+                message = {'n_tokens': n_tokens,
                         'message': {'author': role, 'content': text}}
             else:
                 raise ValueError('Unknown provider')
 
             self.__context.append(message)
+            self.__n_tokens += n_tokens
+            self.__evict()
+            self.__prompt = None
+
+    def add_observation(self, text, provider='openai'):
+        '''
+        Add the result of an action as a message of its own, truncated
+        according to the observation truncation policy: keep the "head"
+        or "tail" of the text, or both ends ("middle" is dropped)
+
+        Input: tool output
+        '''
+        max_tokens = self.__max_observation_tokens
+        if max_tokens is not None and self.__tokenizer.count(text) > max_tokens:
+            tokens = self.__tokenizer.encode(text)
+            if self.__observation_truncation == 'head':
+                text = f'{self.__tokenizer.decode(tokens[:max_tokens])} ...'
+            elif self.__observation_truncation == 'tail':
+                text = f'... {self.__tokenizer.decode(tokens[-max_tokens:])}'
+            elif self.__observation_truncation == 'middle':
+                head, tail = tokens[:max_tokens // 2], tokens[-(max_tokens - max_tokens // 2):]
+                text = f'{self.__tokenizer.decode(head)} ... {self.__tokenizer.decode(tail)}'
+            else:
+                raise ValueError(f'Unknown truncation policy {self.__observation_truncation}')
+        self.add(role='user', text=f'Observation: {text}', provider=provider)
+
+    def add_memories(self, message, memories):
+        '''
+        Add the message of memories recalled for the current turn (if any)
+        before the user's message, the last added. memories are the texts
+        recalled
+        '''
+        if message is None:
+            return
+        n_tokens = self.__tokenizer.count(message['content'])
+        item = {'n_tokens': n_tokens, 'message': message, 'memories': list(memories)}
+        self.__context.insert(max(len(self.__context) - 1, 0), item)
+        self.__n_tokens += n_tokens
+        self.__evict()
+        self.__prompt = None
+
+    def calibrate(self, prompt_tokens):
+        '''
+        Adjust token counts by the number of prompt tokens reported by the
+        provider for the last prompt, compared with our own count of it
+        '''
+        if self.__prompt_tokens is None or self.__prompt_tokens == 0:
+            return
+        ratio = prompt_tokens / self.__prompt_tokens
+        self.__scale = 0.5 * self.__scale + 0.5 * ratio
+        n_messages = len(self.__context)
+        self.__evict()
+        if len(self.__context) != n_messages:
+            self.__prompt = None
+
+    @property
+    def __num_summary_tokens(self):
+        return self.__summary.n_tokens if self.__summary is not None else 0
 
+    def __evict(self):
+        max_prompt_tokens = self.__max_context_tokens - self.__num_response_tokens
+        num_fixed_tokens = self.num_pretext_tokens + self.__num_summary_tokens
+        if (num_fixed_tokens + self.__n_tokens) * self.__scale < max_prompt_tokens:
+            return
+        low_water = num_fixed_tokens + self.__compact_to * (max_prompt_tokens - num_fixed_tokens)
+        while len(self.__context) > 0 and \
+                ((num_fixed_tokens + self.__n_tokens) * self.__scale >= low_water
+                 or (len(self.__context) > 1
+                     and self.__context[0]['message'].get('role') == 'assistant')):
+            item = self.__context.popleft()
+            self.__n_tokens -= item['n_tokens']
+            if self.__on_evict is not None:
+                self.__on_evict(item['message'], item['n_tokens'])
+            # memories are kept elsewhere, so need not be summarized
+            if self.__summary is not None and 'memories' not in item:
+                self.__summary(item['message'], item['n_tokens'])
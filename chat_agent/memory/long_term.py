@@ -0,0 +1,274 @@
+'''
+Long-term memory of past conversations, across sessions.
+
+Each completed turn (the user's message and the agent's answer) is embedded
+and kept on disk, and the memories most relevant to a new message are
+recalled into the prompt, within a budget of tokens:
+
+memories.sqlite: the memories, their sessions, token counts and vectors
+index.faiss: snapshot of the HNSW (approximate nearest neighbor) index
+
+Memories are added to the index in memory as they come (incrementally), and
+stored in SQLite at once. The index on disk is a snapshot of the memories
+up to some id; compaction writes a new snapshot (atomically) in the
+background once compact_every memories have been added since the last one,
+and on close. When loaded, the snapshot is brought up to date with the
+memories stored since, from their stored vectors, so nothing is embedded
+again.
+
+The store is meant for one process (e.g. the server, or the console bot).
+'''
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+import faiss
+import numpy as np
+
+MEMORIES_MESSAGE = 'Things you remember from earlier conversations:\n{memories}'
+
+
+class LongTermMemory:
+    def __init__(self, path, embeddings, tokenizer, M=32, ef_construction=64, ef_search=128,
+                 compact_every=1000):
+        self.path = path
+        self.embeddings = embeddings
+        self.tokenizer = tokenizer
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.compact_every = compact_every
+        self.index = None
+        self.indexed_upto = 0
+        self.n_uncompacted = 0
+        self.compactor = None
+        self.lock = Lock()
+        self.db_lock = Lock()
+        self.writer = ThreadPoolExecutor(1)
+        self.logger = logging.getLogger('chat_log')
+
+        os.makedirs(path, exist_ok=True)
+        self.index_path = os.path.join(path, 'index.faiss')
+        self.conn = sqlite3.connect(os.path.join(path, 'memories.sqlite'), timeout=30,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS memories (
+                id INTEGER PRIMARY KEY, session TEXT, text TEXT, n_tokens INTEGER,
+                created_at REAL, vector BLOB);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        ''')
+        self.conn.commit()
+        self.__load()
+
+    def __len__(self):
+        with self.lock:
+            return self.index.ntotal if self.index is not None else 0
+
+    def remember(self, text, session=None):
+        '''
+        Queue a memory to be embedded and stored, in the background.
+        Returns a future
+        '''
+        return self.writer.submit(self.__remember, text, session)
+
+    def add(self, texts, session=None):
+        '''
+        Embed and store memories
+        '''
+        if len(texts) == 0:
+            return
+        vectors = np.array(self.embeddings.embed_documents(texts), dtype='float32')
+        now = time.time()
+        # memories go into the index in the order of their ids, so that a
+        # snapshot holds every memory up to its last
+        with self.db_lock:
+            ids = []
+            for text, vector in zip(texts, vectors):
+                cursor = self.conn.execute(
+                    'INSERT INTO memories (session, text, n_tokens, created_at, vector) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (session, text, self.tokenizer.count(text), now, vector.tobytes()))
+                ids.append(cursor.lastrowid)
+            self.conn.commit()
+            with self.lock:
+                if self.index is None:
+                    self.index = self.__new_index(vectors.shape[1])
+                self.index.add_with_ids(vectors, np.array(ids, dtype='int64'))
+                self.n_uncompacted += len(ids)
+                compact = self.n_uncompacted >= self.compact_every and \
+                    (self.compactor is None or not self.compactor.is_alive())
+                if compact:
+                    self.compactor = Thread(target=self.compact, daemon=True)
+        if compact:
+            self.compactor.start()
+
+    def __remember(self, text, session):
+        try:
+            self.add([text], session)
+        except Exception as ex:
+            self.logger.error(f'Failed to store a memory: {ex}')
+
+    def recall(self, query, k=5, max_tokens=512, exclude_session=None, exclude=()):
+        '''
+        The texts of up to k memories nearest to the query, nearest first,
+        as many as fit within max_tokens together, other than those in
+        exclude
+        '''
+        if len(self) == 0:
+            return []
+        vector = np.array([self.embeddings.embed_query(query)], dtype='float32')
+        return [text for text, _ in self.search(vector, k, max_tokens, exclude_session, exclude)]
+
+    def search(self, vector, k=5, max_tokens=512, exclude_session=None, exclude=()):
+        '''
+        (text, distance) of up to k memories nearest to an embedded query,
+        within max_tokens
+        '''
+        with self.lock:
+            if self.index is None or self.index.ntotal == 0:
+                return []
+            # over-fetch, to allow for memories excluded or too long
+            distances, ids = self.index.search(vector, min(self.index.ntotal, k * 2 + len(exclude)))
+        found = [(int(id), float(distance)) for id, distance in zip(ids[0], distances[0]) if id >= 0]
+        if len(found) == 0:
+            return []
+        with self.db_lock:
+            rows = self.conn.execute(
+                f'SELECT id, session, text, n_tokens FROM memories WHERE id IN '
+                f'({",".join("?" * len(found))})', [id for id, _ in found]).fetchall()
+        rows = {row[0]: row[1:] for row in rows}
+
+        memories = []
+        n_tokens = 0
+        for id, distance in found:
+            if id not in rows:
+                continue
+            session, text, count = rows[id]
+            if exclude_session is not None and session == exclude_session:
+                continue
+            if text in exclude:
+                continue
+            if n_tokens + count > max_tokens:
+                continue
+            memories.append((text, distance))
+            n_tokens += count
+            if len(memories) == k:
+                break
+        return memories
+
+    def message(self, memories):
+        '''
+        Recalled memories as a message for the prompt, or None
+        '''
+        if len(memories) == 0:
+            return None
+        return {'role': 'system',
+                'content': MEMORIES_MESSAGE.format(memories='\n\n'.join(memories))}
+
+    def compact(self):
+        '''
+        Write a snapshot of the index, with all the memories added so far
+        '''
+        start = time.monotonic()
+        with self.lock:
+            if self.index is None:
+                return
+            # serializing copies the index, so searches need not wait on the
+            # write to disk
+            data = faiss.serialize_index(self.index)
+            indexed_upto = int(faiss.vector_to_array(self.index.id_map).max()) \
+                if self.index.ntotal > 0 else 0
+            n_compacted = self.n_uncompacted
+        temp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        data.tofile(temp_path)
+        os.replace(temp_path, self.index_path)
+        with self.db_lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('indexed_upto', ?)",
+                              (indexed_upto,))
+            self.conn.commit()
+        with self.lock:
+            self.indexed_upto = indexed_upto
+            self.n_uncompacted -= n_compacted
+        self.logger.info(f'Compacted long-term memory index of {indexed_upto} memories '
+                         f'in {time.monotonic() - start:.2f}s')
+
+    def close(self):
+        '''
+        Store the memories queued, and write the index
+        '''
+        self.writer.shutdown(wait=True)
+        if self.compactor is not None:
+            self.compactor.join()
+        if self.n_uncompacted > 0:
+            self.compact()
+
+    def __new_index(self, dim):
+        index = faiss.IndexHNSWFlat(dim, self.M)
+        index.hnsw.efConstruction = self.ef_construction
+        index.hnsw.efSearch = self.ef_search
+        return faiss.IndexIDMap2(index)
+
+    def __load(self):
+        # the snapshot, and the memories stored since it was written
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'indexed_upto'").fetchone()
+        if os.path.exists(self.index_path) and row is not None:
+            self.index = faiss.read_index(self.index_path)
+            faiss.downcast_index(self.index.index).hnsw.efSearch = self.ef_search
+            self.indexed_upto = row[0]
+        rows = self.conn.execute('SELECT id, vector FROM memories WHERE id > ? ORDER BY id',
+                                 (self.indexed_upto,)).fetchall()
+        if len(rows) > 0:
+            vectors = np.array([np.frombuffer(vector, dtype='float32') for _, vector in rows])
+            if self.index is None:
+                self.index = self.__new_index(vectors.shape[1])
+            self.index.add_with_ids(vectors, np.array([id for id, _ in rows], dtype='int64'))
+            self.n_uncompacted = len(rows)
+            self.logger.info(f'Added {len(rows)} memories stored since the last snapshot')
+
+
+def test():
+    import shutil
+    import tempfile
+    try:
+        from chat_agent.memory.tokenizers import get_tokenizer
+        from chat_agent.tools.embeddings import HashingEmbeddings
+    except:
+        from memory.tokenizers import get_tokenizer
+        from tools.embeddings import HashingEmbeddings
+
+    path = tempfile.mkdtemp()
+    tokenizer = get_tokenizer({'type': 'estimate'})
+    try:
+        memory = LongTermMemory(path, HashingEmbeddings(), tokenizer, compact_every=3)
+        facts = ['User: my dog is called Biscuit\nAI: What a lovely name for a dog!',
+                 'User: I live in Moab, Utah\nAI: Moab is beautiful, with its red rocks.',
+                 'User: I am allergic to peanuts\nAI: I will keep that in mind for recipes.',
+                 'User: my favorite color is green\nAI: Green is a calming color.']
+        for indx, fact in enumerate(facts):
+            memory.remember(fact, session=f'session {indx}')
+        memory.writer.submit(lambda: None).result()
+        assert len(memory) == 4
+        recalled = memory.recall('what is the name of my dog?', k=1)
+        assert recalled == [facts[0]], recalled
+        assert memory.recall('what is my dog called', k=4, max_tokens=10) == [], 'over budget'
+        assert facts[0] not in memory.recall('dog', k=4, exclude_session='session 0')
+        assert facts[0] not in memory.recall('dog', k=4, exclude={facts[0]})
+        memory.close()
+        assert memory.indexed_upto == 4
+
+        # memories stored after the last snapshot are restored from SQLite
+        memory = LongTermMemory(path, HashingEmbeddings(), tokenizer, compact_every=100)
+        memory.add(['User: I play the cello\nAI: The cello has a warm sound.'])
+        memory = LongTermMemory(path, HashingEmbeddings(), tokenizer)
+        assert len(memory) == 5 and memory.n_uncompacted == 1
+        assert memory.recall('which instrument do I play?', k=1)[0].startswith('User: I play the cello')
+        print(f'Long-term memory OK: {len(memory)} memories')
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,162 @@
+'''
+Rolling summary of the conversation evicted from the context.
+
+Messages evicted from the context are handed to the summary as they go,
+and summarized in the background, together with the summary so far, so
+that the user's turn never waits on it. The context puts the latest
+summary after the system prompt. Evicted messages arriving while a summary
+is being written are summarized in the next round.
+
+The summaries are written by the agent's model, or by a model of their
+own ("summary_model"), which a model that runs one call at a time (such
+as gpt4all's) needs, so as not to hold up the user's turns.
+
+Summaries are kept within max_tokens, and each round's prompt within the
+model's context, dropping the oldest evicted messages if need be.
+'''
+import logging
+from threading import Lock, Condition
+
+SUMMARY_PROMPT = ('Update the summary of a conversation between a user and an AI agent with '
+                  'the new messages below. Keep names, facts, the user\'s preferences, and the '
+                  'tasks asked for and their results; leave out small talk. Use at most '
+                  '{max_words} words.\n\nSummary so far:\n{summary}\n\nNew messages:\n{messages}')
+SUMMARY_MESSAGE = 'Summary of the earlier conversation:\n{summary}'
+
+
+class RollingSummary:
+    def __init__(self, llm, executor, max_tokens=256, margin=64):
+        self.llm = llm
+        self.executor = executor
+        self.max_tokens = max_tokens
+        max_context = llm.config.get('max_context', 4096)
+        self.budget = max(max_context - llm.config.get('max_tokens', 256) - margin, 64)
+        self.text = None
+        self.n_tokens = 0
+        self.version = 0
+        self.pending = []
+        self.running = False
+        self.lock = Lock()
+        self.idle = Condition(self.lock)
+        self.logger = logging.getLogger('chat_log')
+
+    def __call__(self, message, n_tokens):
+        '''
+        Queue an evicted message to be summarized
+        '''
+        with self.lock:
+            self.pending.append(message)
+            if self.running:
+                return
+            self.running = True
+        self.executor.submit(self.__run)
+
+    @property
+    def message(self):
+        '''
+        The summary as a message for the prompt, or None
+        '''
+        text = self.text
+        if text is None:
+            return None
+        return {'role': 'system', 'content': SUMMARY_MESSAGE.format(summary=text)}
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the messages evicted so far to be summarized
+        '''
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.running, timeout)
+
+    def __run(self):
+        while True:
+            with self.lock:
+                messages, self.pending = self.pending, []
+                if len(messages) == 0:
+                    self.running = False
+                    self.idle.notify_all()
+                    return
+            try:
+                text = self.__summarize(messages)
+            except Exception as ex:
+                self.logger.error(f'Failed to summarize {len(messages)} evicted messages: {ex}')
+                continue
+            n_tokens = self.llm.tokenizer.count(SUMMARY_MESSAGE.format(summary=text))
+            with self.lock:
+                self.text = text
+                self.n_tokens = n_tokens
+                self.version += 1
+            self.logger.info(f'Summarized {len(messages)} evicted messages in {n_tokens} tokens')
+
+    def __summarize(self, messages):
+        lines = [self.__line(message) for message in messages]
+        kwargs = {'max_words': self.max_tokens * 3 // 4, 'summary': self.text or '(none)'}
+
+        # drop the oldest messages which do not fit in the prompt
+        while len(lines) > 1 and self.llm.tokenizer.count(
+                SUMMARY_PROMPT.format(messages='\n'.join(lines), **kwargs)) > self.budget:
+            lines.pop(0)
+        text = self.llm([{'role': 'user', 'content': SUMMARY_PROMPT.format(
+            messages='\n'.join(lines), **kwargs)}]).strip()
+        tokens = self.llm.tokenizer.encode(text)
+        if len(tokens) > self.max_tokens:
+            text = self.llm.tokenizer.decode(tokens[:self.max_tokens])
+        return text
+
+    def __line(self, message):
+        role = message.get('role', message.get('author'))
+        if role == 'assistant':
+            return f'AI: {message["content"]}'
+        if message['content'].startswith('Observation:'):
+            return message['content']
+        return f'User: {message["content"]}'
+
+
+def test():
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        from chat_agent.memory.context import Context
+        from chat_agent.memory.tokenizers import get_tokenizer
+    except:
+        from memory.context import Context
+        from memory.tokenizers import get_tokenizer
+
+    class SlowModel:
+        config = {'max_context': 1024, 'max_tokens': 128}
+        tokenizer = get_tokenizer({'type': 'estimate'})
+
+        def __init__(self):
+            self.calls = 0
+
+        def __call__(self, prompt):
+            self.calls += 1
+            time.sleep(0.3)
+            return f'Summary {self.calls}, of the conversation so far.'
+
+    llm = SlowModel()
+    summary = RollingSummary(llm, ThreadPoolExecutor(2), max_tokens=64)
+    context = Context('You are a helpful assistant.', num_response_tokens=128,
+                      max_context_tokens=1024, tokenizer=llm.tokenizer, summary=summary)
+
+    # adding messages never waits on the summary
+    slowest = 0
+    for turn in range(40):
+        for role in ['user', 'assistant']:
+            start = time.monotonic()
+            context.add(role=role, text=f'{role} message {turn} ' + 'words ' * 40)
+            context.get_prompt()
+            slowest = max(slowest, time.monotonic() - start)
+    assert slowest < 0.1, slowest
+    assert summary.wait(timeout=10)
+
+    prompt = context.get_prompt()
+    assert prompt[1]['role'] == 'system' and prompt[1]['content'].startswith('Summary of'), prompt[1]
+    assert f'Summary {llm.calls},' in prompt[1]['content'], 'prompt should hold the latest summary'
+    n_tokens = sum(llm.tokenizer.count(message['content']) for message in prompt)
+    assert n_tokens < 1024 - 128, n_tokens
+    print(f'Rolling summary OK: {llm.calls} summaries, slowest add {slowest * 1000:.1f} ms, '
+          f'prompt of {len(prompt)} messages, {n_tokens} tokens')
+
+if __name__ == '__main__':
+    test()
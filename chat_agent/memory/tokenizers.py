@@ -0,0 +1,126 @@
+'''
+Token counting for the context buffer.
+
+The tokenizer is chosen per provider by the "tokenizer" entry in the chat
+configuration, e.g.
+
+    "tokenizer": {"type": "tiktoken", "encoding": "o200k_base"}
+    "tokenizer": {"type": "huggingface", "name": "Xenova/llama-3-tokenizer"}
+    "tokenizer": {"type": "estimate", "chars_per_token": 4}
+
+defaulting to tiktoken's p50k_base encoding. Encoders are loaded on first
+use rather than at startup, and token counts are kept in an LRU cache keyed
+by a hash of the content.
+'''
+import hashlib
+import math
+from collections import OrderedDict
+from threading import Lock
+
+
+class Tokenizer:
+    def __init__(self, cache_size=4096):
+        self.__encoder = None
+        self.__cache = OrderedDict()
+        self.__cache_size = cache_size
+        self.__lock = Lock()
+
+    @property
+    def encoder(self):
+        # load encoder on first use
+        if self.__encoder is None:
+            with self.__lock:
+                if self.__encoder is None:
+                    self.__encoder = self.load()
+        return self.__encoder
+
+    def load(self):
+        raise NotImplementedError('load method not implemented')
+
+    def encode(self, text):
+        return self.encoder.encode(text)
+
+    def decode(self, tokens):
+        return self.encoder.decode(tokens)
+
+    def count(self, text):
+        '''
+        Number of tokens in text, cached by content
+        '''
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        with self.__lock:
+            if key in self.__cache:
+                self.__cache.move_to_end(key)
+                return self.__cache[key]
+
+        n_tokens = len(self.encode(text))
+        with self.__lock:
+            self.__cache[key] = n_tokens
+            if len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+        return n_tokens
+
+
+class TiktokenTokenizer(Tokenizer):
+    def __init__(self, encoding=None, model=None, **kwargs):
+        super(TiktokenTokenizer, self).__init__(**kwargs)
+        self.encoding = encoding
+        self.model = model
+
+    def load(self):
+        import tiktoken as tt
+        if self.model is not None:
+            return tt.encoding_for_model(self.model)
+        return tt.get_encoding(self.encoding or 'p50k_base')
+
+
+class HuggingFaceTokenizer(Tokenizer):
+    def __init__(self, name, **kwargs):
+        super(HuggingFaceTokenizer, self).__init__(**kwargs)
+        self.name = name
+
+    def load(self):
+        from tokenizers import Tokenizer as HFTokenizer
+        return HFTokenizer.from_pretrained(self.name)
+
+    def encode(self, text):
+        return self.encoder.encode(text, add_special_tokens=False).ids
+
+
+class EstimateTokenizer(Tokenizer):
+    '''
+    Approximates tokens as fixed length runs of characters, for models
+    without a local tokenizer. Relies on the provider's reported usage
+    to calibrate the context.
+    '''
+    def __init__(self, chars_per_token=4, **kwargs):
+        super(EstimateTokenizer, self).__init__(**kwargs)
+        self.chars_per_token = chars_per_token
+
+    def load(self):
+        return self
+
+    def encode(self, text):
+        return [text[indx:indx + self.chars_per_token]
+                for indx in range(0, len(text), self.chars_per_token)]
+
+    def decode(self, tokens):
+        return ''.join(tokens)
+
+    def count(self, text):
+        return math.ceil(len(text) / self.chars_per_token)
+
+
+def get_tokenizer(config=None):
+    '''
+    Create tokenizer from the "tokenizer" entry of the chat configuration
+    '''
+    config = dict(config or {'type': 'tiktoken'})
+    tokenizer_type = config.pop('type', 'tiktoken')
+    if tokenizer_type == 'tiktoken':
+        return TiktokenTokenizer(**config)
+    if tokenizer_type == 'huggingface':
+        return HuggingFaceTokenizer(**config)
+    if tokenizer_type == 'estimate':
+        return EstimateTokenizer(**config)
+    raise ValueError(f'Unknown tokenizer type {tokenizer_type}')
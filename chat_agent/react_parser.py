@@ -0,0 +1,288 @@
+'''
+Incremental parser for the ReAct formatted output of the LLM.
+
+The response is fed to the parser chunk by chunk as it is generated. Lines
+are classified as they are completed (Thought, Action, Action Input,
+Observation, Final Answer), so that as soon as an action and its input
+are complete the rest of the generation can be cancelled and the tool
+dispatched, rather than waiting for the model to ramble on and invent its
+own observations. An action input may span several lines (e.g. JSON or
+code), and is complete at the next Thought, Action or Observation line,
+or at the end of the generation. Text following "Final Answer:" is handed
+back as it arrives so it can be streamed to the user.
+'''
+
+MARKERS = ('Thought:', 'Action:', 'Observation:', 'Final Answer:')
+
+
+class ReActParser:
+    SCANNING = 'scanning'
+    ACTION_INPUT = 'action input'
+    FINAL_ANSWER = 'final answer'
+    DONE = 'done'
+
+    def __init__(self, multi_action=False):
+        self.multi_action = multi_action
+        self.state = self.SCANNING
+        self.text = ''
+        self.thought = None
+        self.tool = None
+        self.actions = []
+        self.answer = ''
+        self.__line = ''
+        self.__kept = 0
+        self.__input = []
+        self.__input_end = 0
+
+    @property
+    def action_complete(self):
+        '''
+        True once the action(s) and their input have been parsed
+        '''
+        return self.state == self.DONE and len(self.actions) > 0
+
+    def feed(self, chunk):
+        '''
+        Parse the next chunk of generated text.
+
+        Returns any new final answer text
+        '''
+        if self.state == self.DONE:
+            return ''
+        self.text += chunk
+        if self.state == self.FINAL_ANSWER:
+            self.answer += chunk
+            return chunk
+
+        delta = ''
+        self.__line += chunk
+        while '\n' in self.__line and self.state != self.FINAL_ANSWER:
+            line, self.__line = self.__line.split('\n', 1)
+            n_actions = len(self.actions)
+            delta = self.__parse_line(line, complete=True)
+            if self.state == self.ACTION_INPUT:
+                self.__input_end = len(self.text) - len(self.__line)
+            if len(self.actions) > n_actions:
+                # keep the text up to the end of the action's input
+                self.__kept = self.__input_end
+            if self.state == self.DONE:
+                # discard whatever was generated past the action input
+                self.text = self.text[:self.__kept]
+                self.__line = ''
+                return ''
+        if self.state == self.FINAL_ANSWER:
+            # the remainder of the buffer already belongs to the answer
+            delta = f'{delta}\n{self.__line}'
+            self.__line = ''
+        elif 'Final Answer:' in self.__line:
+            n_actions = len(self.actions)
+            delta = self.__parse_line(self.__line, complete=False)
+            self.__line = ''
+            if len(self.actions) > n_actions:
+                self.__kept = self.__input_end
+            if self.state == self.DONE:
+                self.text = self.text[:self.__kept]
+                return ''
+        self.answer += delta
+        return delta
+
+    def finish(self):
+        '''
+        Flush the parser at the end of the generation (including when the
+        provider stopped at a stop sequence).
+
+        Returns any new final answer text
+        '''
+        delta = ''
+        n_actions = len(self.actions)
+        if self.state in [self.SCANNING, self.ACTION_INPUT] and len(self.__line) > 0:
+            self.__parse_line(self.__line, complete=True)
+            self.__line = ''
+            if self.state == self.ACTION_INPUT:
+                self.__input_end = len(self.text)
+        if len(self.actions) > n_actions:
+            self.__kept = self.__input_end
+            n_actions = len(self.actions)
+        if self.state not in [self.FINAL_ANSWER, self.DONE]:
+            if self.tool is not None:
+                # the input runs to the end of the generation (or is missing)
+                self.__add_action('\n'.join(self.__input))
+            if len(self.actions) == 0:
+                # neither an action nor a final answer, so treat the
+                # whole response as the answer
+                self.tool = 'Final Answer'
+                delta = self.text.strip()
+                self.answer = delta
+        if len(self.actions) > n_actions:
+            self.__kept = self.__input_end if len(self.__input) > 0 else len(self.text)
+        if len(self.actions) > 0:
+            self.text = self.text[:self.__kept]
+        self.state = self.DONE
+        return delta
+
+    def result(self):
+        '''
+        Returns tool, tool input (or final answer), and thought, as parsed.
+        When several actions were given, the first.
+        '''
+        if len(self.actions) == 0:
+            return 'Final Answer', self.answer.strip().strip(" ").strip('"'), self.thought
+        tool, tool_input = self.actions[0]
+        return tool, tool_input, self.thought
+
+    def __add_action(self, tool_input):
+        self.actions.append((self.tool, tool_input.strip().strip('"')))
+        self.tool = None
+        self.__input = []
+        self.state = self.SCANNING if self.multi_action else self.DONE
+
+    def __parse_line(self, line, complete):
+        stripped = line.strip()
+        if self.state == self.ACTION_INPUT:
+            if not stripped.startswith(MARKERS) and 'Final Answer:' not in stripped:
+                # the input goes on
+                if len(self.__input) > 0 or len(stripped) > 0:
+                    self.__input.append(line.rstrip())
+                return ''
+            self.__add_action('\n'.join(self.__input))
+            if self.state == self.DONE:
+                return ''
+
+        if 'Final Answer:' in stripped:
+            if len(self.actions) > 0:
+                # an answer to actions not yet taken
+                self.state = self.DONE
+                return ''
+            # a final answer overrides any action so far
+            self.tool = 'Final Answer'
+            self.state = self.FINAL_ANSWER
+            return line.split('Final Answer:', 1)[-1].lstrip()
+
+        if stripped.startswith('Observation:') and len(self.actions) > 0:
+            # the model is imagining the results of the actions
+            self.state = self.DONE
+        elif stripped.startswith('Thought:') and self.thought is None and complete:
+            self.thought = f'{stripped}\n'
+        elif stripped.startswith('Action Input:'):
+            if self.tool is not None:
+                tool_input = stripped[len('Action Input:'):].strip()
+                self.__input = [tool_input] if len(tool_input) > 0 else []
+                self.state = self.ACTION_INPUT
+        elif stripped.startswith('Action:'):
+            self.tool = stripped[len('Action:'):].strip().strip('[]').strip()
+        return ''
+
+
+# transcripts of responses (as generated), and the expected tool, tool
+# input and thought
+TRANSCRIPTS = [
+    ('Thought: The user greeted me.\nFinal Answer: Hello Karen! How can I assist you today?',
+     ('Final Answer', 'Hello Karen! How can I assist you today?', 'Thought: The user greeted me.\n')),
+
+    ('Thought: I will need to look up the weather forecast today, for Moab, Utah. This will take a moment.\n'
+     'Action: search\nAction Input: weather forecast today Moab, Utah\n'
+     'Observation: The weather in Moab is sunny.\nThought: I now know the answer.\n'
+     'Final Answer: It is sunny.',
+     ('search', 'weather forecast today Moab, Utah',
+      'Thought: I will need to look up the weather forecast today, for Moab, Utah. This will take a moment.\n')),
+
+    ('Thought: I will open the first link for the user.\nAction: [open_link]\n'
+     'Action Input: "https://www.weatherforyou.com/report/moab-ut"',
+     ('open_link', 'https://www.weatherforyou.com/report/moab-ut',
+      'Thought: I will open the first link for the user.\n')),
+
+    ('Thought: I need to search for the documentation.\nAction: search\nAction Input:\n'
+     'python random library documentation\n',
+     ('search', 'python random library documentation',
+      'Thought: I need to search for the documentation.\n')),
+
+    ('Thought: I have accomplished finding the Python random library documentation.\n'
+     'Observation: The official documentation is at docs.python.org.\n'
+     'Final Answer: I have opened the official Python documentation for the random library.\n'
+     'You can read it to understand more about the library.',
+     ('Final Answer', 'I have opened the official Python documentation for the random library.\n'
+      'You can read it to understand more about the library.',
+      'Thought: I have accomplished finding the Python random library documentation.\n')),
+
+    ('Hello! I am Susan, how can I help?',
+     ('Final Answer', 'Hello! I am Susan, how can I help?', None)),
+
+    ('Thought: I will search.\nAction: search\n',
+     ('search', '', 'Thought: I will search.\n')),
+
+    ('Thought: I will search with both terms.\nAction: search\nAction Input: {"a": 1,\n "b": 2}\n'
+     'Observation: made up\nFinal Answer: Done.',
+     ('search', '{"a": 1,\n "b": 2}', 'Thought: I will search with both terms.\n')),
+
+    ('Thought: I will open the page.\nAction: open_link\nAction Input:\n'
+     '    https://www.python.org\n\n    https://docs.python.org\n',
+     ('open_link', 'https://www.python.org\n\n    https://docs.python.org',
+      'Thought: I will open the page.\n')),
+
+    ('Thought: x\nAction: search\nAction Input: foo\nFinal Answer: bar',
+     ('search', 'foo', 'Thought: x\n')),
+
+    ("Final Answer: Here's a simple program:\n```python\nprint('Action: none')\n```",
+     ('Final Answer', "Here's a simple program:\n```python\nprint('Action: none')\n```", None)),
+]
+
+
+# transcripts with several independent actions, and the expected actions
+MULTI_ACTION_TRANSCRIPTS = [
+    ('Thought: I will look up both forecasts at once.\n'
+     'Action: search\nAction Input: weather forecast today Moab, Utah\n'
+     'Action: search\nAction Input: weather forecast today Denver, Colorado\n'
+     'Observation: Sunny in both.\nFinal Answer: It is sunny.',
+     [('search', 'weather forecast today Moab, Utah'),
+      ('search', 'weather forecast today Denver, Colorado')]),
+
+    ('Thought: I will open both links.\nAction: open_link\nAction Input: "https://www.python.org"\n'
+     'Thought: And the second one.\nAction: open_link\nAction Input: https://docs.python.org\n'
+     'Final Answer: I have opened both links.',
+     [('open_link', 'https://www.python.org'), ('open_link', 'https://docs.python.org')]),
+
+    ('Thought: Just one search.\nAction: search\nAction Input: python random library',
+     [('search', 'python random library')]),
+
+    ('Thought: Two searches.\nAction: search\nAction Input: a\nAction: search\nAction Input: b\n'
+     'Observation: made up',
+     [('search', 'a'), ('search', 'b')]),
+
+    ('Thought: Two searches.\nAction: search\nAction Input: {"q": "a",\n "n": 1}\n'
+     'Action: search\nAction Input: {"q": "b",\n "n": 2}\nObservation: made up',
+     [('search', '{"q": "a",\n "n": 1}'), ('search', '{"q": "b",\n "n": 2}')]),
+]
+
+
+def test(chunk_sizes=(1, 3, 7, 1000)):
+    for chunk_size in chunk_sizes:
+        for transcript, expected in TRANSCRIPTS:
+            parser = ReActParser()
+            answer = ''
+            for indx in range(0, len(transcript), chunk_size):
+                answer += parser.feed(transcript[indx:indx + chunk_size])
+                if parser.action_complete:
+                    break
+            answer += parser.finish()
+            assert parser.result() == expected, (chunk_size, parser.result(), expected)
+            if expected[0] == 'Final Answer':
+                assert answer.strip() == expected[1], (chunk_size, answer, expected)
+            else:
+                assert 'Observation:' not in parser.text and 'Final Answer:' not in parser.text
+                # the response is kept up to the end of the action's input
+                assert parser.text.rstrip().rstrip('"').endswith(
+                    expected[1].split('\n')[-1].strip()) and expected[2] in parser.text, \
+                    (chunk_size, parser.text, expected)
+        for transcript, expected in MULTI_ACTION_TRANSCRIPTS:
+            parser = ReActParser(multi_action=True)
+            for indx in range(0, len(transcript), chunk_size):
+                parser.feed(transcript[indx:indx + chunk_size])
+                if parser.action_complete:
+                    break
+            parser.finish()
+            assert parser.actions == expected, (chunk_size, parser.actions, expected)
+            assert 'Observation:' not in parser.text and 'Final Answer:' not in parser.text
+    print(f'{len(TRANSCRIPTS) + len(MULTI_ACTION_TRANSCRIPTS)} transcripts parsed correctly')
+
+if __name__ == '__main__':
+    test()
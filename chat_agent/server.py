@@ -0,0 +1,138 @@
+'''
+Serve many conversations with the agent over a local HTTP and WebSocket
+endpoint:
+
+    POST   /sessions/{session_id}/messages   body {"text": ...}; responds with
+                                             the agent's messages as they
+                                             come, one JSON object per line
+    GET    /sessions/{session_id}/ws         WebSocket; send the user's
+                                             messages as text, receive the
+                                             agent's as JSON
+    DELETE /sessions/{session_id}            end the session
+    GET    /stats                            session and turn counts (and
+                                             completion cache hits, and
+                                             latencies of routed backends)
+
+Each message from the agent is {"done": ..., "text": ..., "metadata": ...}.
+A turn which fails (or times out) ends with {"error": ..., "done": true},
+and the session (and WebSocket) stays open for the next message.
+A session with a turn already in progress is answered with 429, and 503 is
+returned when no more sessions can be opened.
+
+Run from the project root, e.g.
+
+    python -m chat_agent.server --port 8080
+'''
+import argparse
+import json
+from aiohttp import web, WSMsgType
+
+try:
+    from chat_agent.chatagent import AgentResources, setup_logging
+    from chat_agent.sessions import SessionManager, SessionBusy, TooManySessions, TurnFailed
+except:
+    from chatagent import AgentResources, setup_logging
+    from sessions import SessionManager, SessionBusy, TooManySessions, TurnFailed
+
+
+def to_json(message):
+    done, text, metadata = message
+    return json.dumps({'done': done, 'text': text, 'metadata': metadata}, default=str)
+
+
+def error_json(ex):
+    return json.dumps({'error': str(ex), 'done': True})
+
+
+async def post_message(request):
+    manager = request.app['manager']
+    try:
+        body = await request.json()
+        messages = manager.turn(request.match_info['session_id'], str(body['text']))
+    except (ValueError, KeyError, TypeError) as ex:
+        raise web.HTTPBadRequest(text=str(ex))
+    except SessionBusy as ex:
+        raise web.HTTPTooManyRequests(text=str(ex))
+    except TooManySessions as ex:
+        raise web.HTTPServiceUnavailable(text=str(ex))
+
+    # write each message as it comes. Writes wait on a slow client, which
+    # in turn holds up the agent
+    async with messages:
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        try:
+            async for message in messages:
+                await response.write(f'{to_json(message)}\n'.encode('utf-8'))
+        except TurnFailed as ex:
+            await response.write(f'{error_json(ex)}\n'.encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+async def websocket(request):
+    manager = request.app['manager']
+    session_id = request.match_info['session_id']
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    async for msg in ws:
+        if msg.type != WSMsgType.TEXT:
+            continue
+        try:
+            messages = manager.turn(session_id, msg.data)
+        except (ValueError, SessionBusy, TooManySessions) as ex:
+            await ws.send_json({'error': str(ex)})
+            continue
+        async with messages:
+            try:
+                async for message in messages:
+                    await ws.send_str(to_json(message))
+            except TurnFailed as ex:
+                await ws.send_str(error_json(ex))
+    return ws
+
+
+async def delete_session(request):
+    if not request.app['manager'].close(request.match_info['session_id']):
+        raise web.HTTPNotFound()
+    return web.json_response({'closed': request.match_info['session_id']})
+
+
+async def stats(request):
+    manager = request.app['manager']
+    stats = {'sessions': len(manager.sessions), **manager.stats}
+    if manager.resources.chat.cache_stats is not None:
+        stats['completion_cache'] = manager.resources.chat.cache_stats
+    if hasattr(manager.resources.chat, 'backend_stats'):
+        stats['backends'] = manager.resources.chat.backend_stats
+    return web.json_response(stats)
+
+
+def create_app(manager):
+    app = web.Application()
+    app['manager'] = manager
+    app.add_routes([web.post('/sessions/{session_id}/messages', post_message),
+                    web.get('/sessions/{session_id}/ws', websocket),
+                    web.delete('/sessions/{session_id}', delete_session),
+                    web.get('/stats', stats)])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the chat agent to many users')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-sessions', type=int, default=500)
+    parser.add_argument('--max-concurrent-turns', type=int, default=64)
+    parser.add_argument('--turn-timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    setup_logging()
+    manager = SessionManager(AgentResources(),
+                             max_sessions=args.max_sessions,
+                             max_concurrent_turns=args.max_concurrent_turns,
+                             turn_timeout=args.turn_timeout)
+    web.run_app(create_app(manager), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+'''
+Host many conversations in one process.
+
+The chat model, tools and system prompt are loaded once (AgentResources)
+and shared by all sessions. Each session holds only its own context buffer
+and transcript, in an AsyncChatAgent built on the shared resources.
+
+Limits:
+
+max_sessions: sessions kept at once (idle sessions are closed to make room)
+max_pending: turns a session may have running or waiting at once
+max_concurrent_turns: turns running at once over all sessions
+max_message_chars: length of a user's message
+turn_timeout: seconds a turn may take before it is cancelled
+queue_size: messages buffered for a turn before the agent has to wait for
+    the client to read them (backpressure)
+
+A turn which fails, or times out, ends with TurnFailed; the session stays
+open for the next message.
+'''
+import asyncio
+import logging
+import time
+
+try:
+    from chat_agent.async_chatagent import AsyncChatAgent
+    from chat_agent.chat_logging import ChatLogging
+except:
+    from async_chatagent import AsyncChatAgent
+    from chat_logging import ChatLogging
+
+
+class SessionBusy(Exception):
+    pass
+
+
+class TooManySessions(Exception):
+    pass
+
+
+class TurnFailed(Exception):
+    pass
+
+
+class Slot:
+    '''
+    A turn's place among the session's pending turns, given back once
+    '''
+    def __init__(self, session):
+        self.session = session
+        self.released = False
+        session.pending += 1
+        session.last_used = time.monotonic()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.session.pending -= 1
+            self.session.last_used = time.monotonic()
+
+
+class Turn:
+    '''
+    The agent's messages for a turn, as an async iterator. The session's
+    slot is given back once the turn ends, is closed (also as an async
+    context manager), or is dropped, even if never iterated
+    '''
+    def __init__(self, slot, messages):
+        self.slot = slot
+        self.messages = messages
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.messages.__anext__()
+
+    async def aclose(self):
+        try:
+            await self.messages.aclose()
+        finally:
+            self.slot.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def __del__(self):
+        self.slot.release()
+
+
+class Session:
+    def __init__(self, session_id, resources, chat_dir=None):
+        self.session_id = session_id
+        chat_logger = ChatLogging(name=f'chat-{session_id}', chat_dir=chat_dir,
+                                  **resources.config.get('transcript', {}))
+        self.agent = AsyncChatAgent(resources=resources, chat_logger=chat_logger)
+        self.lock = asyncio.Lock()
+        self.pending = 0
+        self.last_used = time.monotonic()
+
+
+class SessionManager:
+    def __init__(self, resources, max_sessions=500, max_pending=1, max_concurrent_turns=64,
+                 max_message_chars=4000, idle_timeout=1800, turn_timeout=120, queue_size=16,
+                 chat_dir=None):
+        self.resources = resources
+        self.max_sessions = max_sessions
+        self.max_pending = max_pending
+        self.max_message_chars = max_message_chars
+        self.idle_timeout = idle_timeout
+        self.turn_timeout = turn_timeout
+        self.queue_size = queue_size
+        self.chat_dir = chat_dir
+        self.sessions = {}
+        self.semaphore = asyncio.Semaphore(max_concurrent_turns)
+        self.stats = {'turns': 0, 'active_turns': 0, 'rejected': 0, 'timeouts': 0, 'errors': 0}
+        self.logger = logging.getLogger('chat_log')
+
+    def get(self, session_id):
+        '''
+        Get session, creating it if need be
+        '''
+        session = self.sessions.get(session_id)
+        if session is None:
+            if len(self.sessions) >= self.max_sessions:
+                self.__close_idle()
+            if len(self.sessions) >= self.max_sessions:
+                self.stats['rejected'] += 1
+                raise TooManySessions(f'Limit of {self.max_sessions} sessions reached')
+            session = Session(session_id, self.resources, chat_dir=self.chat_dir)
+            self.sessions[session_id] = session
+        return session
+
+    def close(self, session_id):
+        return self.sessions.pop(session_id, None) is not None
+
+    def turn(self, session_id, text):
+        '''
+        Start a turn of the conversation with the user's message.
+
+        Returns a Turn, an async iterator of the agent's messages as (done,
+        text, metadata); closing it early cancels the turn. Raises
+        TurnFailed, after any messages sent, if the turn fails.
+        '''
+        if len(text) > self.max_message_chars:
+            raise ValueError(f'Message is longer than {self.max_message_chars} characters')
+        session = self.get(session_id)
+        if session.pending >= self.max_pending:
+            self.stats['rejected'] += 1
+            raise SessionBusy(f'Session {session_id} already has a turn in progress')
+        slot = Slot(session)
+        return Turn(slot, self.__run_turn(session, text, slot))
+
+    async def __run_turn(self, session, text, slot):
+        try:
+            async with session.lock, self.semaphore:
+                self.stats['turns'] += 1
+                self.stats['active_turns'] += 1
+                message_queue = asyncio.Queue(maxsize=self.queue_size)
+                task = asyncio.create_task(asyncio.wait_for(session.agent(text, message_queue),
+                                                            timeout=self.turn_timeout))
+                try:
+                    while True:
+                        get = asyncio.ensure_future(message_queue.get())
+                        await asyncio.wait([get, task], return_when=asyncio.FIRST_COMPLETED)
+                        if not get.done():
+                            # agent has finished (or failed) without a final answer
+                            get.cancel()
+                            if task.exception() is not None:
+                                raise task.exception()
+                            if message_queue.empty():
+                                break
+                            continue
+                        message = get.result()
+                        yield message
+                        if message[0]:
+                            break
+                except asyncio.TimeoutError:
+                    self.stats['timeouts'] += 1
+                    self.logger.error(f'Turn of session {session.session_id} timed out')
+                    raise TurnFailed(f'The turn took longer than {self.turn_timeout} seconds')
+                except Exception as ex:
+                    self.stats['errors'] += 1
+                    self.logger.error(f'Turn of session {session.session_id} failed: {ex}')
+                    raise TurnFailed(f'The turn failed: {ex}')
+                finally:
+                    if not task.done():
+                        task.cancel()
+                    self.stats['active_turns'] -= 1
+        finally:
+            slot.release()
+
+    def __close_idle(self):
+        # close sessions idle for longer than the idle timeout, or failing
+        # that, the least recently used idle session
+        now = time.monotonic()
+        idle = [(session.last_used, session_id) for session_id, session in self.sessions.items()
+                if session.pending == 0]
+        for last_used, session_id in idle:
+            if now - last_used > self.idle_timeout:
+                del self.sessions[session_id]
+        if len(self.sessions) >= self.max_sessions and len(idle) > 0:
+            _, session_id = min(idle)
+            self.sessions.pop(session_id, None)
+
+
+def test():
+    import gc
+    try:
+        from chat_agent.chatagent import AgentResources
+    except:
+        from chatagent import AgentResources
+
+    config = {'provider': 'chat_fake', 'model': 'fake', 'tokenizer': {'type': 'estimate'},
+              'max_context': 4096, 'max_tokens': 256, 'first_token_delay': 0,
+              'token_delay': 0, 'summarize_history': False,
+              'responses': ['Thought: A greeting.\nFinal Answer: Hello there!']}
+
+    async def run():
+        manager = SessionManager(AgentResources(config=config, tools=[]))
+
+        # a turn dropped before it is iterated (e.g. the client went away)
+        # gives back its slot
+        manager.turn('session', 'hello')
+        gc.collect()
+        messages = manager.turn('session', 'hello')
+        try:
+            manager.turn('session', 'hello again')
+        except SessionBusy:
+            pass
+        else:
+            raise AssertionError('a second turn should have been refused')
+
+        # and one closed before it is iterated
+        await messages.aclose()
+        async with manager.turn('session', 'hello') as messages:
+            replies = [message async for message in messages]
+        assert replies[-1][0] and manager.sessions['session'].pending == 0, replies
+        print(f'Sessions OK: {manager.stats}')
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,103 @@
+'''
+Startup profile: how long each step of starting up took, from the time this
+module was first imported (the console bot imports it first), and which
+packages each step imported.
+
+Steps are recorded as they run, in any thread, e.g.
+
+    with timed('chat model'):
+        chat = load_chat_model(config)
+    mark('first response')
+
+and report() lists them in the order they started. For the import time of
+every module, run Python with -X importtime instead.
+'''
+import sys
+import time
+from contextlib import contextmanager
+from threading import Lock, current_thread
+
+_origin = time.perf_counter()
+_steps = []
+_lock = Lock()
+
+
+@contextmanager
+def timed(step):
+    '''
+    Record how long the step takes, and the packages newly imported meanwhile
+    '''
+    modules = set(sys.modules)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        imported = set(sys.modules) - modules
+        packages = sorted({_outermost(name, imported) for name in imported
+                           if not name.startswith('_')})
+        record(step, start, elapsed, packages)
+
+
+def _outermost(name, imported):
+    # the package (or module) of name which was itself newly imported
+    parts = name.split('.')
+    for indx in range(1, len(parts)):
+        if '.'.join(parts[:indx]) in imported:
+            return '.'.join(parts[:indx])
+    return name
+
+
+def mark(step):
+    '''
+    Record a point in time, e.g. the first response
+    '''
+    record(step, time.perf_counter(), 0, [])
+
+
+def record(step, start, elapsed, packages):
+    with _lock:
+        _steps.append((start - _origin, elapsed, current_thread().name, step, packages))
+
+
+def report(max_packages=8):
+    '''
+    The steps recorded so far, as text
+    '''
+    with _lock:
+        steps = sorted(_steps)
+    lines = ['Startup profile (seconds since start, seconds taken):']
+    for start, elapsed, thread, step, packages in steps:
+        line = f'{start:8.3f} {elapsed:8.3f}  {step}'
+        if thread != 'MainThread':
+            line += f' [{thread}]'
+        if len(packages) > 0:
+            more = f' and {len(packages) - max_packages} more' if len(packages) > max_packages else ''
+            line += f' (imported {", ".join(packages[:max_packages])}{more})'
+        lines.append(line)
+    lines.append(f'{len(sys.modules)} modules loaded')
+    return '\n'.join(lines)
+
+
+def test():
+    from threading import Thread
+
+    def warm_up():
+        with timed('warm up'):
+            import xml.dom.minidom
+            time.sleep(0.05)
+
+    thread = Thread(target=warm_up, name='warm-up')
+    thread.start()
+    time.sleep(0.01)
+    with timed('first step'):
+        time.sleep(0.01)
+    thread.join()
+    mark('done')
+    text = report()
+    print(text)
+    assert [step for _, _, _, step, _ in sorted(_steps)] == ['warm up', 'first step', 'done']
+    assert 'warm up [warm-up] (imported' in text and 'xml' in text, text
+
+if __name__ == '__main__':
+    test()
@@ -1,35 +1,151 @@
-''' 
+'''
 Ansynchronous web scraping for search tool.
 Thank you to ChatGPT for its assistance!
+
+The scraper is long lived: its HTTP session (and so its connections) is
+reused from one search to the next. At most max_connections pages are
+fetched at once, and at most max_per_host from any one host. Bodies are
+streamed, and cut off after max_bytes; responses which are not HTML are
+dropped without reading them, and each page has timeout seconds to arrive.
+Documents are handed on page by page as they come (iter_documents).
+
+Pages are parsed and split into chunks in a pool of parse_workers processes
+(parse_pool 'process'), or threads ('thread'), or on the event loop itself
+('inline'), so that parsing one page does not hold up fetching the others.
+With main_content, only the main content of each page is kept (see
+html_text.py). Given an HttpCache, pages are served from it when fresh, and
+revalidated when stale (see http_cache.py).
 '''
 import asyncio
 import aiohttp
 import logging
+import multiprocessing
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlsplit
 from fake_useragent import UserAgent
-from bs4 import BeautifulSoup
-import re
+from langchain_core.documents import Document
+
+try:
+    from chat_agent.tools.html_text import page_chunks, default_parser
+except:
+    from tools.html_text import page_chunks, default_parser
+
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+
+
+class _LoopState:
+    # session and limits, which belong to the event loop they are used on
+    def __init__(self, max_connections, max_per_host):
+        connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_per_host,
+                                         ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.max_per_host = max_per_host
+        self.host_semaphores = {}
+
+    def host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        return self.host_semaphores[host]
+
 
 class AsyncWebScraper:
-    def __init__(self, text_splitter, verbose=False):
+    def __init__(self, text_splitter, verbose=False, max_connections=20, max_per_host=4,
+                 max_bytes=2000000, timeout=5, chunk_size=65536, parse_pool='process',
+                 parse_workers=None, parser=None, main_content=True, cache=None):
         self.text_splitter = text_splitter
         self.verbose = verbose
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.parse_pool = parse_pool
+        self.parse_workers = parse_workers or min(4, os.cpu_count() or 1)
+        self.parser = parser or default_parser()
+        self.main_content = main_content
+        self.cache = cache
+        self.executor = None
+        self.executor_lock = Lock()
         self.logger = logging.getLogger('chat_log')
+        self.states = weakref.WeakKeyDictionary()
+        try:
+            user_agent = UserAgent().chrome
+        except Exception:
+            user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 ' \
+                         '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+        self.headers = {'User-Agent': user_agent}
+
+    def __state(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.states:
+            self.states[loop] = _LoopState(self.max_connections, self.max_per_host)
+        return self.states[loop]
 
-    async def process_item(self, session, item):
-        ua = UserAgent
-        header = {'User-Agent': str(ua.chrome)}
-        self.logger.info(f'Requesting {item["link"]}')
+    async def fetch(self, url):
+        '''
+        Returns the page's HTML (up to max_bytes of it), or None if it is not
+        an HTML page
+        '''
+        state = self.__state()
+        async with state.semaphore, state.host_semaphore(url):
+            return await asyncio.wait_for(self.__fetch(state.session, url), timeout=self.timeout)
+
+    async def __fetch(self, session, url):
+        cached = None
+        headers = self.headers
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, url)
+            if cached is not None and cached.fresh:
+                self.cache.count('hit', url)
+                return cached.text
+            if cached is not None:
+                headers = {**headers, **cached.conditional_headers()}
+
+        self.logger.info(f'Requesting {url}')
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                self.cache.count('revalidated', url)
+                await asyncio.to_thread(self.cache.refresh, url, response.headers)
+                return cached.text
+            if self.cache is not None:
+                self.cache.count('miss', url)
+            if response.status != 200:
+                self.logger.error(f'Status {response.status} from {url}')
+                return None
+            if response.content_type not in HTML_TYPES:
+                self.logger.info(f'Skipping {url} of type {response.content_type}')
+                return None
+
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                body += chunk
+                if len(body) >= self.max_bytes:
+                    self.logger.info(f'Cut off {url} at {self.max_bytes} bytes')
+                    del body[self.max_bytes:]
+                    break
+            text = body.decode(response.charset or 'utf-8', errors='replace')
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put, url, text, response.headers)
+            return text
+
+    async def process_item(self, item):
         try:
-            async with session.get(item['link'], headers=header, timeout=5) as response:
-                article_text = await response.text()
-                self.logger.info(f'Processing {item["link"]}')
-                soup = BeautifulSoup(article_text, 'html.parser')
-                text = soup.get_text().strip()
-                text = re.sub(r'\n+', '\n', text)
-                documents = self.text_splitter.create_documents([text],
-                                metadatas=[{'reference': (item['title'], item['link'])}])
-                self.logger.info('Successful')
-                return documents
+            article_text = await self.fetch(item['link'])
+            if article_text is None:
+                return []
+            self.logger.info(f'Processing {item["link"]}')
+            chunks, stats = await self.__parse(article_text)
+            self.logger.info(f'Kept {stats["kept"]} characters of text, dropped {stats["dropped"]}')
+            documents = [Document(page_content=chunk,
+                                  metadata={'reference': (item['title'], item['link'])})
+                         for chunk in chunks]
+            self.logger.info('Successful')
+            return documents
         except asyncio.TimeoutError:
             # Handle timeout error here
             await asyncio.to_thread(self.logger.error, f'Request timed out on {item["link"]}')
@@ -37,21 +153,150 @@ class AsyncWebScraper:
         except Exception as e:
             # Log the exception within an asynchronous context
             await asyncio.to_thread(self.logger.error, f'Error occurred: {str(e)}')
-        
-    async def get_documents(self, items):
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for item in items:
-                task = asyncio.create_task(self.process_item(session, item))
-                tasks.append(task)
-
-            docs = []
-            completed = 0
+            return []
+
+    async def __parse(self, html):
+        if self.parse_pool == 'inline':
+            return page_chunks(html, self.text_splitter, self.parser, self.main_content)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor(), page_chunks, html, self.text_splitter, self.parser,
+            self.main_content)
+
+    def __executor(self):
+        with self.executor_lock:
+            if self.executor is None:
+                if self.parse_pool == 'process':
+                    # spawn rather than fork, as the agent runs threads
+                    self.executor = ProcessPoolExecutor(
+                        self.parse_workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self.executor = ThreadPoolExecutor(self.parse_workers)
+            return self.executor
+
+    async def iter_documents(self, items):
+        '''
+        Yields the documents of each page as soon as it is processed
+        '''
+        tasks = [asyncio.create_task(self.process_item(item))
+                 for item in items if 'link' in item]
+        try:
             for task in asyncio.as_completed(tasks):
                 documents = await task
-                try:
-                    docs += documents
-                except TypeError:
-                    pass
-                completed += 1
+                if len(documents) > 0:
+                    yield documents
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.cache is not None:
+                self.cache.log_stats()
+
+    async def get_documents(self, items):
+        docs = []
+        async for documents in self.iter_documents(items):
+            docs += documents
         return docs
+
+    async def close(self):
+        '''
+        Close the session used on the running event loop
+        '''
+        state = self.states.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state.session.close()
+
+    def shutdown(self):
+        '''
+        Stop the parsing pool
+        '''
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+def test():
+    import time
+    from aiohttp import web
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    active = {'now': 0, 'max': 0}
+
+    async def page(request):
+        active['now'] += 1
+        active['max'] = max(active['max'], active['now'])
+        await asyncio.sleep(0.1)
+        active['now'] -= 1
+        return web.Response(text=f'<html><body><p>Page {request.match_info["n"]}</p></body></html>',
+                            content_type='text/html')
+
+    async def big(request):
+        # endless page, which must be cut off
+        response = web.StreamResponse(headers={'Content-Type': 'text/html'})
+        await response.prepare(request)
+        try:
+            while True:
+                await response.write(b'<p>' + b'x' * 10000 + b'</p>\n')
+        except ConnectionError:
+            return response
+
+    async def pdf(request):
+        return web.Response(body=b'%PDF' + b'0' * 100000, content_type='application/pdf')
+
+    async def slow(request):
+        await asyncio.sleep(10)
+        return web.Response(text='<p>too late</p>', content_type='text/html')
+
+    async def run():
+        app = web.Application()
+        app.add_routes([web.get('/page/{n}', page), web.get('/big', big),
+                        web.get('/pdf', pdf), web.get('/slow', slow)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 8766).start()
+        url = 'http://127.0.0.1:8766'
+
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
+        scraper = AsyncWebScraper(text_splitter, max_per_host=2, max_bytes=100000, timeout=1,
+                                  parse_pool='thread')
+        items = [{'title': f'page {n}', 'link': f'{url}/page/{n}'} for n in range(6)]
+        items += [{'title': 'big', 'link': f'{url}/big'}, {'title': 'pdf', 'link': f'{url}/pdf'},
+                  {'title': 'slow', 'link': f'{url}/slow'}]
+
+        start = time.perf_counter()
+        first = None
+        docs = []
+        async for documents in scraper.iter_documents(items):
+            if first is None:
+                first = time.perf_counter() - start
+            docs += documents
+        elapsed = time.perf_counter() - start
+
+        sources = set([doc.metadata['reference'][0] for doc in docs])
+        assert sources == set([f'page {n}' for n in range(6)] + ['big']), sources
+        big_chars = sum(len(doc.page_content) for doc in docs if doc.metadata['reference'][0] == 'big')
+        assert big_chars <= 100000, 'big page should be cut off'
+        assert active['max'] <= 2, 'at most 2 requests to a host at once'
+        assert first < 0.5 and elapsed < 2, 'pages should be handed on as they come'
+
+        # the session is reused for the next search
+        session = scraper.states[asyncio.get_running_loop()].session
+        await scraper.get_documents(items[:2])
+        assert scraper.states[asyncio.get_running_loop()].session is session
+        await scraper.close()
+        scraper.shutdown()
+
+        # parsing in worker processes gives the same chunks
+        process_scraper = AsyncWebScraper(text_splitter, max_bytes=100000, timeout=5)
+        process_docs = await process_scraper.get_documents(items[-3:-1])
+        assert [doc.page_content for doc in process_docs] == \
+            [doc.page_content for doc in docs if doc.metadata['reference'][0] == 'big']
+        await process_scraper.close()
+        process_scraper.shutdown()
+        await runner.cleanup()
+        print(f'{len(docs)} documents from {len(sources)} pages; first page after '
+              f'{first:.2f}s, all after {elapsed:.2f}s; at most {active["max"]} requests at once')
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    test()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 
@@ -24,6 +25,10 @@ class BaseTool:
     
     def run(self, input):
         return (f'Dummy tool, input was {input}', None)
+
+    async def arun(self, input):
+        # tools without a native coroutine run in a worker thread
+        return await asyncio.to_thread(self.run, input)
     
     def post_process(self, **args):
         raise NotImplementedError('post_process method not implemented.')
@@ -0,0 +1,233 @@
+'''
+Embedding cache for the search tool.
+
+CachedEmbeddings wraps an embeddings object (anything with embed_documents
+and embed_query, such as langchain's OpenAIEmbeddings) with a cache on disk,
+keyed by a hash of the text. Chunks seen before (the same page, split the
+same way) and repeated queries are not embedded again. Texts which are not
+cached are deduplicated, and sent to the embedder in batches of up to
+batch_size.
+
+Embedders, chosen with the "embeddings" parameter of the search tool in
+tools.json (see get_embeddings):
+
+openai: OpenAI's embedding model, via langchain (the default)
+hashing: local and offline. Words and word pairs are hashed into a term
+    frequency vector, which is reduced by a fixed random projection, with
+    NumPy. Cheap and predictable on a CPU, if less discerning
+sentence_transformers: a small local sentence embedding model (needs the
+    sentence-transformers package)
+fake: FakeEmbeddings, a deterministic stand-in embedder for tests: the same
+    text always gives the same (unit length) vector, and it counts the
+    texts it has been asked to embed
+'''
+import hashlib
+import logging
+import re
+import sqlite3
+import zlib
+from threading import Lock
+
+import numpy as np
+
+
+class CachedEmbeddings:
+    def __init__(self, embeddings, path, batch_size=64, max_entries=500000, namespace=None):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_entries = max_entries
+        # vectors from different models must not be mixed up
+        self.namespace = namespace if namespace is not None else \
+            getattr(embeddings, 'model', type(embeddings).__name__)
+        self.stats = {'hits': 0, 'misses': 0, 'batches': 0}
+        self.logger = logging.getLogger('chat_log')
+        self.lock = Lock()
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)')
+        self.conn.commit()
+
+    def embed_documents(self, texts):
+        return self.__embed(texts, 'document', self.embeddings.embed_documents)
+
+    def embed_query(self, text):
+        return self.__embed([text], 'query',
+                            lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+    def __embed(self, texts, kind, embed):
+        keys = [self.__key(kind, text) for text in texts]
+        vectors = self.__lookup(set(keys))
+
+        # embed each text not yet cached once, in batches
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        missing = list(missing.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            embedded = embed([text for _, text in batch])
+            self.stats['batches'] += 1
+            new = {key: vector for (key, _), vector in zip(batch, embedded)}
+            self.__store(new)
+            vectors.update(new)
+
+        n_hits = len(texts) - len(missing)
+        self.stats['hits'] += n_hits
+        self.stats['misses'] += len(missing)
+        self.logger.info(f'Embedding cache: {n_hits} hits, {len(missing)} misses '
+                         f'({len(texts)} {kind} texts)')
+        return [list(vectors[key]) for key in keys]
+
+    def __key(self, kind, text):
+        return hashlib.blake2b(f'{self.namespace}\0{kind}\0{text}'.encode('utf-8'),
+                               digest_size=16).hexdigest()
+
+    def __lookup(self, keys):
+        vectors = {}
+        keys = list(keys)
+        with self.lock:
+            # stay under SQLite's limit on query parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(batch))})',
+                    batch)
+                for key, vector in rows:
+                    vectors[key] = np.frombuffer(vector, dtype='float32').tolist()
+        return vectors
+
+    def __store(self, vectors):
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                [(key, np.asarray(vector, dtype='float32').tobytes())
+                 for key, vector in vectors.items()])
+            # drop the oldest entries beyond the cap
+            n_entries = self.conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            if n_entries > self.max_entries:
+                self.conn.execute(
+                    'DELETE FROM embeddings WHERE rowid IN '
+                    '(SELECT rowid FROM embeddings ORDER BY rowid LIMIT ?)',
+                    (n_entries - self.max_entries,))
+            self.conn.commit()
+
+
+class HashingEmbeddings:
+    def __init__(self, dim=256, n_features=2 ** 13, bigrams=True, seed=0):
+        self.dim = dim
+        self.n_features = n_features
+        self.bigrams = bigrams
+        self.model = f'hashing-{dim}-{n_features}-{int(bigrams)}-{seed}'
+        self.projection = np.random.default_rng(seed).standard_normal(
+            (n_features, dim)).astype('float32') / np.sqrt(dim)
+        self.word = re.compile(r'\w+')
+
+    def embed_documents(self, texts):
+        # term frequencies of all texts in one matrix, projected at once
+        counts = np.zeros((len(texts), self.n_features), dtype='float32')
+        for row, text in enumerate(texts):
+            counts[row] = np.bincount(self.__features(text), minlength=self.n_features)
+        # dampen frequent terms
+        vectors = np.log1p(counts) @ self.projection
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def __features(self, text):
+        words = self.word.findall(text.lower())
+        terms = words
+        if self.bigrams:
+            terms = words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+        return np.array([zlib.crc32(term.encode('utf-8')) % self.n_features for term in terms],
+                        dtype='int64')
+
+
+class SentenceTransformerEmbeddings:
+    def __init__(self, model='all-MiniLM-L6-v2', batch_size=32):
+        from sentence_transformers import SentenceTransformer
+        self.model = model
+        self.batch_size = batch_size
+        self.encoder = SentenceTransformer(model, device='cpu')
+
+    def embed_documents(self, texts):
+        return self.encoder.encode(texts, batch_size=self.batch_size,
+                                   normalize_embeddings=True).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class FakeEmbeddings:
+    def __init__(self, dim=64):
+        self.dim = dim
+        self.n_embedded = 0
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        self.n_embedded += 1
+        seed = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+def get_embeddings(config=None):
+    '''
+    Create embedder from the "embeddings" parameter of the search tool
+    '''
+    config = dict(config or {'type': 'openai'})
+    embeddings_type = config.pop('type', 'openai')
+    if embeddings_type == 'openai':
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(**config)
+    if embeddings_type == 'hashing':
+        return HashingEmbeddings(**config)
+    if embeddings_type == 'sentence_transformers':
+        return SentenceTransformerEmbeddings(**config)
+    if embeddings_type == 'fake':
+        return FakeEmbeddings(**config)
+    raise ValueError(f'Unknown embeddings type {embeddings_type}')
+
+
+def test():
+    import os
+    import tempfile
+
+    fake = FakeEmbeddings()
+    path = os.path.join(tempfile.mkdtemp(), 'embeddings.sqlite')
+    embeddings = CachedEmbeddings(fake, path, batch_size=4)
+
+    chunks = [f'chunk {indx % 6}' for indx in range(10)]
+    first = embeddings.embed_documents(chunks)
+    assert fake.n_embedded == 6, 'duplicate chunks should be embedded once'
+    assert embeddings.stats['batches'] == 2
+
+    # a later search overlapping the first, by a new process
+    embeddings = CachedEmbeddings(fake, path, batch_size=4)
+    second = embeddings.embed_documents(chunks[:5] + ['chunk 6', 'chunk 7'])
+    assert fake.n_embedded == 8, 'cached chunks should not be embedded again'
+    assert np.allclose(first[:5], second[:5])
+    assert np.allclose(second[5], fake.embed_query('chunk 6'))
+
+    embeddings.embed_query('a query')
+    embeddings.embed_query('a query')
+    assert embeddings.stats['hits'] == 6
+    print(f'Embedding cache OK: {embeddings.stats}')
+
+    # similar texts should be nearer each other than unrelated ones
+    hashing = get_embeddings({'type': 'hashing'})
+    first, similar, unrelated = np.array(hashing.embed_documents(
+        ['The forecast for Moab is sunny and warm today',
+         'Sunny and warm weather forecast in Moab',
+         'Python random module documentation']))
+    assert np.sum((first - similar) ** 2) < np.sum((first - unrelated) ** 2)
+    assert np.allclose(hashing.embed_query('Python random'), hashing.embed_query('python  random'))
+    print('Hashing embeddings OK')
+
+if __name__ == '__main__':
+    test()
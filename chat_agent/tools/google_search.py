@@ -1,21 +1,29 @@
-import requests
 import os
+import re
 import asyncio
 import time
+from threading import Lock
 
 from dotenv import load_dotenv
-from collections import defaultdict
 
-from langchain_openai import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 
 try:
     from chat_agent.tools.async_web_scraper import AsyncWebScraper
     from chat_agent.tools.base_tool import BaseTool
+    from chat_agent.tools.embeddings import CachedEmbeddings, get_embeddings
+    from chat_agent.tools.http_cache import HttpCache
+    from chat_agent.tools.search_client import SearchClient
+    from chat_agent.tools.summarizer import Summarizer
+    from chat_agent.tools.search_cache import SearchCache
 except:
     from tools.async_web_scraper import AsyncWebScraper
     from tools.base_tool import BaseTool
+    from tools.embeddings import CachedEmbeddings, get_embeddings
+    from tools.http_cache import HttpCache
+    from tools.search_client import SearchClient
+    from tools.summarizer import Summarizer
+    from tools.search_cache import SearchCache
 
 
 class Tool(BaseTool):
@@ -24,63 +32,100 @@ class Tool(BaseTool):
         self.num_search = kwargs.get('num_search', 10)
         self.k_best = kwargs.get('k_best', 5)
         self.l2_threshold = kwargs.get('l2_threshold', 0.4)
+        self.mmr_lambda = kwargs.get('mmr_lambda', 0.7)
+        self.max_per_source = kwargs.get('max_per_source', 2)
+        self.min_coverage = kwargs.get('min_coverage', min(2, self.k_best))
         self.verbose = kwargs.get('verbose', False)
-        self.db = None
+        self.loop = None
+        self.loop_lock = Lock()
+        self.summarizer = Summarizer(llm, workers=kwargs.get('summary_workers', 4))
 
         load_dotenv()
         self.google_api_key = os.getenv('GOOGLE_API_KEY')
         self.google_cx = os.getenv('GOOGLE_CSE_ID')
+        self.search_client = SearchClient(self.google_api_key, self.google_cx,
+                                          num=self.num_search,
+                                          ttl=kwargs.get('search_ttl', 3600))
 
-        self.embeddings = OpenAIEmbeddings()
         self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
 
+        # vector DB (and embeddings of chunks, and pages) persist on disk,
+        # shared by restarts and processes
+        cache_dir = kwargs.get('cache_dir', os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'search_cache'))
+        os.makedirs(cache_dir, exist_ok=True)
+        http_cache = HttpCache(os.path.join(cache_dir, 'http.sqlite'),
+                               max_bytes=kwargs.get('http_cache_bytes', 200000000))
+        self.scraper = AsyncWebScraper(self.text_splitter,
+                                       max_connections=kwargs.get('max_connections', 20),
+                                       max_per_host=kwargs.get('max_per_host', 4),
+                                       max_bytes=kwargs.get('max_page_bytes', 2000000),
+                                       timeout=kwargs.get('page_timeout', 5),
+                                       parse_pool=kwargs.get('parse_pool', 'process'),
+                                       parse_workers=kwargs.get('parse_workers'),
+                                       parser=kwargs.get('parser'),
+                                       main_content=kwargs.get('main_content', True),
+                                       cache=http_cache)
+        self.embeddings = CachedEmbeddings(get_embeddings(kwargs.get('embeddings')),
+                                           os.path.join(cache_dir, 'embeddings.sqlite'),
+                                           batch_size=kwargs.get('embedding_batch_size', 64))
+        # vectors from each embedder are kept apart
+        db_dir = os.path.join(cache_dir, re.sub(r'\W+', '_', self.embeddings.namespace))
+        self.db = SearchCache(db_dir, self.embeddings,
+                              ttl=kwargs.get('cache_ttl', 86400),
+                              max_docs=kwargs.get('cache_max_docs', 50000),
+                              compact_every=kwargs.get('cache_compact_every', 2000))
+
     def __get_pages(self, query):
         if self.verbose:
             print(f'Searching the web for {self.num_search} websites on \"{query}\"')
 
         # call Google custom search engine to find websites
-        url = 'https://www.googleapis.com/customsearch/v1'
-        params = {"key": self.google_api_key,
-                  "cx": self.google_cx,
-                  "q": query,
-                  "num": self.num_search}
-        response = requests.get(url, params)
-
-        if response.status_code != 200:
-            return [{"error_response": response.status_code}]
-        return response.json()['items']
+        return self.search_client.search(query)
     
     async def __get_documents_async(self, items):
         if self.verbose:
             print('Fetching pages and breaking into chunks')
 
-        scraper = AsyncWebScraper(self.text_splitter)
-        docs = await scraper.get_documents(items)
+        # embed each page's chunks as it arrives, while the rest are still
+        # being fetched (the embeddings are cached for storing them after)
+        docs = []
+        embedding = []
+        async for documents in self.scraper.iter_documents(items):
+            docs += documents
+            embedding.append(asyncio.create_task(asyncio.to_thread(
+                self.embeddings.embed_documents, [doc.page_content for doc in documents])))
+        await asyncio.gather(*embedding)
 
         if self.verbose:
             print('')
         return docs
     
     def __get_documents(self, items):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop.run_until_complete(self.__get_documents_async(items))
+        # reuse one event loop for the tool, rather than a new one per search
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+            return self.loop.run_until_complete(self.__get_documents_async(items))
     
+    def __new_items(self, items):
+        # pages already in the vector DB, and still fresh, need not be fetched
+        return [item for item in items if not self.db.is_fresh(item.get('link'))]
+
     def __store_documents(self, docs):
         # vectorize documents and select best k_best
         if self.verbose:
             print(f'Create and load documents to vector DB')
-        if self.db is None:
-            self.db = FAISS.from_documents(documents=docs, embedding=self.embeddings)
-        else:
-            temp_db = FAISS.from_documents(documents=docs, embedding=self.embeddings)
-            self.db.merge_from(temp_db)
+        self.db.add_documents(docs)
 
     def __get_selections(self, query):
         if self.verbose:
             print('Semantic search on vector DB')
-        # vectorize documents and select best k_best
-        selections = self.db.similarity_search_with_score(query, k=self.k_best)
+        # select k_best relevant, but diverse, documents
+        selections = self.db.max_marginal_relevance_search(query, k=self.k_best,
+                                                           fetch_k=self.k_best * 4,
+                                                           lambda_mult=self.mmr_lambda,
+                                                           max_per_source=self.max_per_source)
         if self.verbose:
             print(f'The relevant documents I found:')
             for selection in selections:
@@ -88,20 +133,21 @@ class Tool(BaseTool):
             print('')
         return selections
     
+    def __is_relevant(self, selections):
+        # near the query on average, with at least min_coverage documents
+        # within the threshold
+        if len(selections) == 0:
+            return False
+        distances = [distance for _, distance in selections]
+        n_near = len([distance for distance in distances if distance < self.l2_threshold])
+        return sum(distances) / len(distances) < self.l2_threshold and n_near >= self.min_coverage
+
     def __get_summary(self, selections):
         if self.verbose:
             print('Summarizing findings.')
-        # get references used, in ranked order
-        hash = defaultdict(int)
-        for selection in selections:
-            hash[selection[0].metadata['reference']] += 1
-        counts = [(k, v) for k, v in hash.items()]
-        counts.sort(key=lambda x: x[1], reverse=True)
-        references = [link for link, _ in counts]
-
-        # have LMM summarize extracted information
-        prompt = f'Write a detailed summary of the following information: {selections}'
-        summary = self.llm([{'role': 'user', 'content': prompt}])
+        # have LMM summarize extracted information, with the references
+        # used in ranked order
+        summary, references = self.summarizer(selections)
         summary = f'{references}\n\n{summary}'
         if self.verbose:
             print(f'Summary: {summary}')
@@ -109,13 +155,13 @@ class Tool(BaseTool):
     
     def run(self, query):
         # if we have data, see if query is valid for it
-        if self.db is not None:
+        if len(self.db) > 0:
             if self.verbose:
                 selections = self.__timeit(self.__get_selections, (query,))
             else:
                 selections = self.__get_selections(query)
-            # if distance < threshold, we can use those results
-            if selections[0][1] < self.l2_threshold:
+            # if close enough, we can use those results
+            if self.__is_relevant(selections):
                 self.logger.info('Found relevant documents in cache.')
                 if self.verbose:
                     print('Re-using previous search data')
@@ -130,7 +176,7 @@ class Tool(BaseTool):
         if self.verbose:
             overall_start = time.time()
 
-            items = self.__timeit(self.__get_pages, (query,))      
+            items = self.__new_items(self.__timeit(self.__get_pages, (query,)))
             docs = self.__timeit(self.__get_documents, (items,))
             self.__timeit(self.__store_documents, (docs,))
             selections = self.__timeit(self.__get_selections, (query,))
@@ -139,7 +185,7 @@ class Tool(BaseTool):
             overall_elapsed = time.time() - overall_start
             print(f'Total elapsed time = {overall_elapsed: .3f}')
         else:
-            items = self.__get_pages(query)       
+            items = self.__new_items(self.__get_pages(query))
             docs = self.__get_documents(items)
             self.__store_documents(docs)
             selections = self.__get_selections(query)
@@ -148,6 +194,24 @@ class Tool(BaseTool):
         self.logger.info(f'Relevant documents: {selections}')
         return output
     
+    async def arun(self, query):
+        # blocking steps run in worker threads, and pages are fetched on the
+        # calling event loop
+        if len(self.db) > 0:
+            selections = await asyncio.to_thread(self.__get_selections, query)
+            if self.__is_relevant(selections):
+                self.logger.info('Found relevant documents in cache.')
+                return await asyncio.to_thread(self.__get_summary, selections)
+            self.logger.info('No relevant documents in cache, searching for more.')
+
+        items = self.__new_items(await asyncio.to_thread(self.__get_pages, query))
+        docs = await self.__get_documents_async(items)
+        await asyncio.to_thread(self.__store_documents, docs)
+        selections = await asyncio.to_thread(self.__get_selections, query)
+        output = await asyncio.to_thread(self.__get_summary, selections)
+        self.logger.info(f'Relevant documents: {selections}')
+        return output
+
     def __timeit(self, func, args):
         start = time.time()
         output = func(*args)
@@ -0,0 +1,117 @@
+'''
+Extracting text from pages and splitting it into chunks, for the search
+tool.
+
+These are plain functions of picklable arguments, so that the scraper can
+run them in a process pool, off the event loop (see AsyncWebScraper).
+parser is any parser BeautifulSoup supports: html.parser (built in), or
+the faster lxml, if it is installed.
+
+With main_content, only the main content of a page is kept, as
+readability does: scripts, styles, navigation, headers and footers, and
+elements whose class or id mark them as boilerplate (cookie banners,
+share buttons, comments, ads...) are dropped. Then paragraphs are scored
+by their length and commas, their scores given to their parent (and half
+to their grandparent), discounted by the share of their text in links, and
+the best scoring element is kept, with those siblings which score nearly
+as well. Pages on which no main content is found are kept whole (less the
+boilerplate).
+'''
+import re
+from bs4 import BeautifulSoup
+
+BOILERPLATE_TAGS = ['script', 'style', 'noscript', 'template', 'svg', 'iframe', 'form',
+                    'button', 'input', 'select', 'nav', 'header', 'footer', 'aside']
+BOILERPLATE = re.compile(r'(^|[-_\s])(cookies?|consent|banner|nav|navbar|menu|breadcrumbs?|'
+                         r'share|social|comments?|related|sidebar|footer|header|ads?|advert\w*|'
+                         r'sponsored|newsletter|subscribe|promo|popup|modal|byline)([-_\s]|$)',
+                         re.IGNORECASE)
+PARAGRAPHS = ['p', 'pre', 'td', 'blockquote']
+KEEP = ['html', 'body', 'main', 'article']
+
+
+def clean_text(text):
+    return re.sub(r'\n+', '\n', text.strip())
+
+
+def extract_text(html, parser='html.parser'):
+    return clean_text(BeautifulSoup(html, parser).get_text())
+
+
+def extract_main_text(html, parser='html.parser', min_chars=250):
+    '''
+    Returns the text of the page's main content, and the length of the
+    whole page's text
+    '''
+    soup = BeautifulSoup(html, parser)
+    n_page_chars = len(clean_text(soup.get_text()))
+    _drop_boilerplate(soup)
+
+    # score paragraphs' parents and grandparents
+    candidates = {}
+    for paragraph in soup.find_all(PARAGRAPHS):
+        text = paragraph.get_text(' ', strip=True)
+        if len(text) < 25:
+            continue
+        score = 1 + text.count(',') + min(len(text) // 100, 3)
+        for ancestor, share in [(paragraph.parent, 1), (getattr(paragraph.parent, 'parent', None), 0.5)]:
+            if ancestor is not None and ancestor.name is not None:
+                candidates.setdefault(id(ancestor), [ancestor, 0])[1] += score * share
+    for candidate in candidates.values():
+        candidate[1] *= 1 - _link_density(candidate[0])
+
+    text = ''
+    if len(candidates) > 0:
+        top, top_score = max(candidates.values(), key=lambda candidate: candidate[1])
+        threshold = max(10, top_score * 0.2)
+        parts = []
+        for sibling in top.parent.children if top.parent is not None else [top]:
+            if sibling is top or (sibling.name is not None and
+                                  candidates.get(id(sibling), [None, 0])[1] >= threshold):
+                parts.append(sibling.get_text())
+        text = clean_text('\n'.join(parts))
+    if len(text) < min_chars:
+        text = clean_text(soup.get_text())
+    return text, n_page_chars
+
+
+def page_chunks(html, text_splitter, parser='html.parser', main_content=True):
+    '''
+    Returns the page's text, split into chunks, with the number of
+    characters of text kept and dropped
+    '''
+    if main_content:
+        text, n_page_chars = extract_main_text(html, parser)
+    else:
+        text = extract_text(html, parser)
+        n_page_chars = len(text)
+    return text_splitter.split_text(text), {'kept': len(text), 'dropped': n_page_chars - len(text)}
+
+
+def default_parser():
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+
+def _drop_boilerplate(soup):
+    for tag in soup(BOILERPLATE_TAGS):
+        tag.decompose()
+    for tag in soup.find_all(True):
+        if tag.decomposed or tag.name in KEEP or tag.attrs is None:
+            continue
+        classes = tag.get('class') or []
+        if isinstance(classes, str):
+            classes = [classes]
+        marks = ' '.join(classes + [tag.get('id') or ''])
+        if BOILERPLATE.search(marks):
+            tag.decompose()
+
+
+def _link_density(tag):
+    n_chars = len(tag.get_text(strip=True))
+    if n_chars == 0:
+        return 1
+    return min(1, sum(len(link.get_text(strip=True)) for link in tag.find_all('a')) / n_chars)
@@ -0,0 +1,218 @@
+'''
+On-disk HTTP cache for the scraper.
+
+Pages are stored (compressed, in SQLite) with their ETag and Last-Modified
+headers. A page is fresh for its Cache-Control max-age, or until its
+Expires header, or failing those for a tenth of the time since it was last
+modified (at most default_ttl seconds). Fresh pages are served from the
+cache; stale ones are revalidated with a conditional GET, and served from
+the cache if the server answers 304 Not Modified. Pages marked no-store
+are not kept, and no-cache pages are always revalidated.
+
+The cache is held to max_bytes (compressed), evicting the least recently
+used pages first. Hits, revalidations and misses are counted in stats, and
+logged to the chat log.
+'''
+import logging
+import sqlite3
+import time
+import zlib
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+
+class CachedPage:
+    def __init__(self, text, etag, last_modified, expires_at):
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires_at
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class HttpCache:
+    def __init__(self, path, max_bytes=200000000, default_ttl=3600):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.stats = {'hit': 0, 'revalidated': 0, 'miss': 0}
+        self.logger = logging.getLogger('chat_log')
+        self.lock = Lock()
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT,
+                expires_at REAL, last_access REAL, size INTEGER)''')
+        self.conn.commit()
+
+    def get(self, url):
+        '''
+        Returns the cached page (fresh or not), or None
+        '''
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT body, etag, last_modified, expires_at FROM pages WHERE url = ?',
+                (url,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE pages SET last_access = ? WHERE url = ?', (time.time(), url))
+            self.conn.commit()
+        body, etag, last_modified, expires_at = row
+        return CachedPage(zlib.decompress(body).decode('utf-8'), etag, last_modified, expires_at)
+
+    def put(self, url, text, headers):
+        '''
+        Store a page with its response headers
+        '''
+        expires_at = self.__expires_at(headers)
+        if expires_at is None:
+            return
+        body = zlib.compress(text.encode('utf-8'))
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, body, headers.get('ETag'), headers.get('Last-Modified'),
+                 expires_at, time.time(), len(body)))
+            self.__evict()
+            self.conn.commit()
+
+    def refresh(self, url, headers):
+        '''
+        Mark a page revalidated (by a 304 response) fresh again
+        '''
+        expires_at = self.__expires_at(headers)
+        with self.lock:
+            if expires_at is None:
+                self.conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+            else:
+                self.conn.execute('UPDATE pages SET expires_at = ? WHERE url = ?',
+                                  (expires_at, url))
+            self.conn.commit()
+
+    def count(self, outcome, url):
+        self.stats[outcome] += 1
+        self.logger.info(f'HTTP cache {outcome}: {url}')
+
+    def log_stats(self):
+        total = sum(self.stats.values())
+        if total > 0:
+            self.logger.info(f'HTTP cache: {self.stats["hit"]} hits, {self.stats["revalidated"]} '
+                             f'revalidated, {self.stats["miss"]} misses '
+                             f'({(self.stats["hit"] + self.stats["revalidated"]) / total:.0%} '
+                             'served from cache)')
+
+    def __expires_at(self, headers):
+        # None if the page may not be stored
+        now = time.time()
+        cache_control = [directive.strip().lower()
+                         for directive in headers.get('Cache-Control', '').split(',')]
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return None
+        if 'no-cache' in cache_control:
+            return now
+        for directive in cache_control:
+            if directive.startswith('max-age='):
+                try:
+                    return now + int(directive[len('max-age='):])
+                except ValueError:
+                    break
+        try:
+            if 'Expires' in headers:
+                return parsedate_to_datetime(headers['Expires']).timestamp()
+            if 'Last-Modified' in headers:
+                age = now - parsedate_to_datetime(headers['Last-Modified']).timestamp()
+                return now + min(max(age, 0) / 10, self.default_ttl)
+        except (TypeError, ValueError):
+            return now
+        return now + self.default_ttl
+
+    def __evict(self):
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute('SELECT url, size FROM pages ORDER BY last_access').fetchall()
+        evicted = []
+        for url, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((url,))
+            total -= size
+        self.conn.executemany('DELETE FROM pages WHERE url = ?', evicted)
+        self.logger.info(f'HTTP cache evicted {len(evicted)} pages')
+
+
+def test():
+    import asyncio
+    import os
+    import tempfile
+    from aiohttp import web
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    try:
+        from chat_agent.tools.async_web_scraper import AsyncWebScraper
+    except:
+        from tools.async_web_scraper import AsyncWebScraper
+
+    served = {'etag': 0, 'fresh': 0, 'nostore': 0, 'not_modified': 0}
+    text = '<html><body><p>' + 'Some text about the weather, and more. ' * 20 + '</p></body></html>'
+
+    async def etag(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            served['not_modified'] += 1
+            return web.Response(status=304, headers={'ETag': '"v1"', 'Cache-Control': 'max-age=0'})
+        served['etag'] += 1
+        return web.Response(text=text, content_type='text/html',
+                            headers={'ETag': '"v1"', 'Cache-Control': 'max-age=0'})
+
+    async def fresh(request):
+        served['fresh'] += 1
+        return web.Response(text=text, content_type='text/html',
+                            headers={'Cache-Control': 'max-age=60'})
+
+    async def nostore(request):
+        served['nostore'] += 1
+        return web.Response(text=text, content_type='text/html',
+                            headers={'Cache-Control': 'no-store'})
+
+    async def run():
+        app = web.Application()
+        app.add_routes([web.get('/etag', etag), web.get('/fresh', fresh), web.get('/nostore', nostore)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 8768).start()
+        items = [{'title': name, 'link': f'http://127.0.0.1:8768/{name}'}
+                 for name in ['etag', 'fresh', 'nostore']]
+
+        cache = HttpCache(os.path.join(tempfile.mkdtemp(), 'http.sqlite'))
+        scraper = AsyncWebScraper(RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0),
+                                  parse_pool='inline', cache=cache)
+        first = await scraper.get_documents(items)
+        second = await scraper.get_documents(items)
+        await scraper.close()
+        await runner.cleanup()
+
+        assert [doc.page_content for doc in first] == [doc.page_content for doc in second]
+        assert served == {'etag': 1, 'fresh': 1, 'nostore': 2, 'not_modified': 1}, served
+        assert cache.stats == {'hit': 1, 'revalidated': 1, 'miss': 4}, cache.stats
+
+        # the least recently used pages are evicted beyond max_bytes
+        cache.max_bytes = 1
+        cache.put('http://example.com/', text, {})
+        assert cache.get(items[0]['link']) is None and cache.get('http://example.com/') is None
+        print(f'HTTP cache OK: served {served}, cache {cache.stats}')
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,64 @@
+'''
+A tool imported and constructed on first use (or when warmed up in the
+background), so that its imports (e.g. langchain and FAISS for search) do
+not hold up startup. A tool which fails to load answers each action with
+an observation saying it is not available, rather than stopping the agent.
+'''
+import asyncio
+import importlib
+import logging
+from threading import Lock
+try:
+    from chat_agent.startup import timed
+except:
+    from startup import timed
+
+
+class LazyTool:
+    def __init__(self, tool_name, module_name, llm, **kwargs):
+        self.tool_name = tool_name
+        self.module_name = module_name
+        self.llm = llm
+        self.kwargs = kwargs
+        self.tool = None
+        self.error = None
+        self.lock = Lock()
+        self.logger = logging.getLogger('chat_log')
+
+    @property
+    def loaded(self):
+        return self.tool is not None or self.error is not None
+
+    def load(self):
+        '''
+        The tool, imported and constructed once (callers meanwhile wait for
+        it), or None if it failed to load
+        '''
+        with self.lock:
+            if not self.loaded:
+                try:
+                    with timed(f'tool {self.tool_name}'):
+                        # a sibling of this module, in chat_agent.tools or tools
+                        module = importlib.import_module('.' + self.module_name, __package__)
+                        self.tool = module.Tool(self.tool_name, self.llm, **self.kwargs)
+                except Exception as ex:
+                    self.error = ex
+                    self.logger.error(f'Failed to load the {self.tool_name} tool: {ex}')
+            return self.tool
+
+    def __call__(self, input, tool_queue):
+        tool = self.load()
+        if tool is not None:
+            return tool(input, tool_queue)
+        if tool_queue is None:
+            return self.__unavailable()
+        tool_queue.put(self.__unavailable())
+
+    async def arun(self, input):
+        tool = self.tool if self.tool is not None else await asyncio.to_thread(self.load)
+        if tool is None:
+            return self.__unavailable()
+        return await tool.arun(input)
+
+    def __unavailable(self):
+        return (f'The {self.tool_name} tool is not available ({self.error}).', None)
@@ -0,0 +1,347 @@
+'''
+Persistent vector store for the search tool.
+
+Chunks of scraped pages are kept on disk, so that they survive restarts and
+can be shared by several processes:
+
+docs.sqlite: the chunks, their vectors, their sources, and when each source
+    was fetched
+index.faiss: snapshot of the FAISS index of the chunks up to some id (read
+    memory-mapped)
+
+Each source (URL) is fresh for ttl seconds after it was fetched; stale
+chunks are not returned by searches, and the source is re-fetched (and its
+chunks replaced) when it next turns up in a search. The store is capped at
+max_docs chunks, evicting the least recently used sources first.
+
+Adding chunks only writes to SQLite (under its write lock). Chunks added
+since the snapshot are searched in a small index in memory (a sidecar),
+which each process brings up to date from SQLite before searching, so
+every process sees the others' additions; removed chunks are left out as
+they are no longer in SQLite. Once compact_every chunks have been added or
+removed since the snapshot, a new snapshot is written in the background,
+replacing the file atomically and bumping a version number, and readers
+reload it when the version has changed.
+'''
+import os
+import time
+import sqlite3
+from threading import Lock, Thread
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+
+class SearchCache:
+    def __init__(self, path, embeddings, ttl=86400, max_docs=50000, compact_every=2000):
+        self.path = path
+        self.embeddings = embeddings
+        self.ttl = ttl
+        self.max_docs = max_docs
+        self.compact_every = compact_every
+        self.index = None
+        self.sidecar = None
+        self.sidecar_upto = 0
+        self.version = None
+        self.compactor = None
+        self.lock = Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self.index_path = os.path.join(path, 'index.faiss')
+        self.conn = self.__connect()
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT, title TEXT, content TEXT,
+                vector BLOB);
+            CREATE INDEX IF NOT EXISTS docs_url ON docs(url);
+            CREATE TABLE IF NOT EXISTS sources (
+                url TEXT PRIMARY KEY, fetched_at REAL, last_access REAL);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        ''')
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def is_fresh(self, url):
+        '''
+        Whether chunks from url were fetched within the ttl
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT fetched_at FROM sources WHERE url = ?',
+                                    (url,)).fetchone()
+        return row is not None and time.time() - row[0] < self.ttl
+
+    def add_documents(self, docs):
+        '''
+        Embed and store chunks, replacing any previously stored for the
+        same sources
+        '''
+        if len(docs) == 0:
+            return
+        vectors = np.array(self.embeddings.embed_documents([doc.page_content for doc in docs]),
+                           dtype='float32')
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                # replace chunks of sources fetched again
+                urls = set([doc.metadata['reference'][1] for doc in docs])
+                n_changes = self.__remove_sources(urls)
+
+                self.conn.executemany(
+                    'INSERT INTO docs (url, title, content, vector) VALUES (?, ?, ?, ?)',
+                    [(doc.metadata['reference'][1], doc.metadata['reference'][0],
+                      doc.page_content, vector.tobytes()) for doc, vector in zip(docs, vectors)])
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO sources (url, fetched_at, last_access) VALUES (?, ?, ?)',
+                    [(url, now, now) for url in urls])
+                n_changes += len(docs)
+
+                # evict least recently used sources beyond the cap
+                n_docs = self.conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+                while n_docs > self.max_docs:
+                    url = self.conn.execute(
+                        'SELECT sources.url FROM sources JOIN docs ON docs.url = sources.url '
+                        'ORDER BY sources.last_access LIMIT 1').fetchone()[0]
+                    count = self.__remove_sources([url])
+                    n_changes += count
+                    n_docs -= count
+
+                changes = self.__meta('changes', 0) + n_changes
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('changes', ?)",
+                                  (changes,))
+                self.conn.execute('COMMIT')
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            compact = changes >= self.compact_every and \
+                (self.compactor is None or not self.compactor.is_alive())
+            if compact:
+                self.compactor = Thread(target=self.compact, daemon=True)
+                self.compactor.start()
+
+    def similarity_search_with_score(self, query, k=5):
+        '''
+        Returns the k chunks (which are still fresh) nearest to the query,
+        with their (squared) L2 distances
+        '''
+        vector = np.array([self.embeddings.embed_query(query)], dtype='float32')
+        return self.__search(vector, k)
+
+    def max_marginal_relevance_search(self, query, k=5, fetch_k=20, lambda_mult=0.7,
+                                      max_per_source=None):
+        '''
+        Returns k chunks, with their (squared) L2 distances, chosen from the
+        fetch_k nearest to the query for their relevance to the query less
+        their similarity to those already chosen (weighed by lambda_mult),
+        with at most max_per_source from any one source
+        '''
+        vector = np.array([self.embeddings.embed_query(query)], dtype='float32')
+        candidates = self.__search(vector, fetch_k, with_vectors=True)
+        if len(candidates) == 0:
+            return []
+        vectors = np.array([candidate[2] for candidate in candidates])
+
+        # cosine similarities to the query and among the candidates
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        query_similarity = vectors @ (vector[0] / max(np.linalg.norm(vector[0]), 1e-12))
+        similarity = vectors @ vectors.T
+        sources = [candidate[0].metadata['reference'] for candidate in candidates]
+
+        selected = []
+        per_source = {}
+        redundancy = np.zeros(len(candidates))
+        available = np.ones(len(candidates), dtype=bool)
+        while len(selected) < k and available.any():
+            scores = lambda_mult * query_similarity - (1 - lambda_mult) * redundancy
+            scores[~available] = -np.inf
+            choice = int(np.argmax(scores))
+            selected.append(choice)
+            available[choice] = False
+            # drop duplicates of the chosen chunk
+            available[similarity[choice] > 0.999] = False
+            redundancy = np.maximum(redundancy, similarity[choice])
+            per_source[sources[choice]] = per_source.get(sources[choice], 0) + 1
+            if max_per_source is not None and per_source[sources[choice]] >= max_per_source:
+                available[[source == sources[choice] for source in sources]] = False
+        return [candidates[indx][:2] for indx in selected]
+
+    def compact(self):
+        '''
+        Write a new snapshot of the index, of all the chunks stored so far
+        '''
+        # a connection of its own, so searches need not wait
+        conn = self.__connect()
+        try:
+            conn.execute('BEGIN')
+            changes = self.__meta('changes', 0, conn)
+            rows = conn.execute('SELECT id, vector FROM docs ORDER BY id').fetchall()
+            conn.execute('COMMIT')
+            if len(rows) == 0:
+                return
+            indexed_upto = rows[-1][0]
+            index = faiss.IndexIDMap2(faiss.IndexFlatL2(len(rows[0][1]) // 4))
+            index.add_with_ids(np.array([np.frombuffer(vector, dtype='float32')
+                                         for _, vector in rows]),
+                               np.array([id for id, _ in rows], dtype='int64'))
+            del rows
+            temp_path = f'{self.index_path}.{os.getpid()}.tmp'
+            faiss.write_index(index, temp_path)
+
+            # replaced under the write lock, so snapshots (of any process)
+            # only move forward, together with their version
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.__meta('indexed_upto', 0, conn) > indexed_upto:
+                    os.remove(temp_path)
+                    conn.execute('ROLLBACK')
+                    return
+                os.replace(temp_path, self.index_path)
+                conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                 [('indexed_upto', indexed_upto),
+                                  ('version', self.__meta('version', 0, conn) + 1),
+                                  ('changes', max(self.__meta('changes', 0, conn) - changes, 0))])
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+    def __search(self, vector, k, with_vectors=False):
+        # (document, distance) of the k nearest fresh chunks, and their
+        # vectors if asked for
+        with self.lock:
+            indexes = [index for index in self.__load_index()
+                       if index is not None and index.ntotal > 0]
+            # over-fetch, to allow for stale and removed chunks
+            found = {}
+            for index in indexes:
+                distances, ids = index.search(vector, min(index.ntotal, k * 4))
+                for distance, id in zip(distances[0], ids[0]):
+                    if id >= 0:
+                        found[int(id)] = min(float(distance), found.get(int(id), np.inf))
+
+            selections = []
+            accessed = set()
+            for id, distance in sorted(found.items(), key=lambda item: item[1]):
+                row = self.conn.execute(
+                    'SELECT docs.url, docs.title, docs.content, docs.vector, sources.fetched_at '
+                    'FROM docs JOIN sources ON docs.url = sources.url WHERE docs.id = ?',
+                    (id,)).fetchone()
+                if row is None or time.time() - row[4] >= self.ttl:
+                    continue
+                url, title, content, vector_bytes, _ = row
+                selection = (Document(page_content=content, metadata={'reference': (title, url)}),
+                             distance)
+                if with_vectors:
+                    selection += (np.frombuffer(vector_bytes, dtype='float32').copy(),)
+                selections.append(selection)
+                accessed.add(url)
+                if len(selections) == k:
+                    break
+            self.conn.executemany('UPDATE sources SET last_access = ? WHERE url = ?',
+                                  [(time.time(), url) for url in accessed])
+        return selections
+
+    def __load_index(self):
+        # (re)load the snapshot if another process (or this one) has written
+        # a new one, and add the chunks stored since the sidecar was last
+        # brought up to date
+        version = self.__meta('version', 0)
+        if self.version != version:
+            indexed_upto = self.__meta('indexed_upto', 0)
+            self.index = None
+            if os.path.exists(self.index_path):
+                self.index = faiss.read_index(self.index_path,
+                                              faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            self.sidecar = None
+            self.sidecar_upto = indexed_upto
+            self.version = version
+        rows = self.conn.execute('SELECT id, vector FROM docs WHERE id > ? ORDER BY id',
+                                 (self.sidecar_upto,)).fetchall()
+        if len(rows) > 0:
+            vectors = np.array([np.frombuffer(vector, dtype='float32') for _, vector in rows])
+            if self.sidecar is None:
+                self.sidecar = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+            self.sidecar.add_with_ids(vectors, np.array([id for id, _ in rows], dtype='int64'))
+            self.sidecar_upto = rows[-1][0]
+        return [self.index, self.sidecar]
+
+    def __meta(self, key, default, conn=None):
+        conn = conn if conn is not None else self.conn
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def __connect(self):
+        conn = sqlite3.connect(os.path.join(self.path, 'docs.sqlite'), timeout=30,
+                               check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA mmap_size=268435456')
+        return conn
+
+    def __remove_sources(self, urls):
+        # the number of chunks removed
+        n_removed = 0
+        for url in urls:
+            n_removed += self.conn.execute('DELETE FROM docs WHERE url = ?', (url,)).rowcount
+            self.conn.execute('DELETE FROM sources WHERE url = ?', (url,))
+        return n_removed
+
+
+def test():
+    import shutil
+    import tempfile
+    try:
+        from chat_agent.tools.embeddings import HashingEmbeddings
+    except:
+        from tools.embeddings import HashingEmbeddings
+
+    def page(url, texts):
+        return [Document(page_content=text, metadata={'reference': (url, url)}) for text in texts]
+
+    path = tempfile.mkdtemp()
+    try:
+        db = SearchCache(path, HashingEmbeddings(), max_docs=12, compact_every=8)
+        other = SearchCache(path, HashingEmbeddings(), max_docs=12, compact_every=8)
+        db.add_documents(page('moab', ['Sunny and warm in Moab today', 'Moab has red rocks']))
+        assert not os.path.exists(db.index_path), 'adding should not write the index'
+        found = other.similarity_search_with_score('weather in Moab', k=1)
+        assert found[0][0].page_content == 'Sunny and warm in Moab today', found
+
+        # chunks of a source fetched again replace the earlier ones
+        db.add_documents(page('moab', ['Rain in Moab today']))
+        assert [doc.page_content for doc, _ in other.similarity_search_with_score('Moab', k=5)] \
+            == ['Rain in Moab today']
+
+        # compacted in the background once enough chunks have changed, and
+        # the new snapshot is picked up by the other store
+        for indx in range(4):
+            db.add_documents(page(f'python{indx}', [f'Python random module part {indx}',
+                                                    f'Python docs page {indx}']))
+        db.compactor.join()
+        assert os.path.exists(db.index_path) and len(db) == 9
+        found = other.max_marginal_relevance_search('Python random module', k=3,
+                                                    max_per_source=1)
+        assert len(found) == 3 and len({doc.metadata['reference'] for doc, _ in found}) == 3
+        n_indexed = other.index.ntotal + (other.sidecar.ntotal if other.sidecar is not None else 0)
+        assert n_indexed == 9, 'the snapshot should hold only the chunks still stored'
+
+        # the least recently used sources are evicted beyond max_docs
+        time.sleep(0.01)
+        other.similarity_search_with_score('Moab', k=1)
+        oldest = db.conn.execute('SELECT url FROM sources ORDER BY last_access LIMIT 1').fetchone()[0]
+        db.add_documents(page('denver', [f'Denver forecast {indx}' for indx in range(6)]))
+        if db.compactor is not None:
+            db.compactor.join()
+        assert len(db) <= 12 and db.is_fresh('moab') and not db.is_fresh(oldest)
+        found = other.similarity_search_with_score(f'Python docs page {oldest[-1]}', k=12)
+        assert all(doc.metadata['reference'][1] != oldest for doc, _ in found)
+        print(f'Search cache OK: {len(db)} chunks, snapshot version {other.version}')
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    test()
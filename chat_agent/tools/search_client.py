@@ -0,0 +1,156 @@
+'''
+Client for Google's custom search engine (CSE), for the search tool.
+
+Results are cached for ttl seconds by normalized query (case and spacing
+ignored), holding at most max_queries queries, least recently used first
+out. When the same query is asked again while a request for it is still
+in flight (e.g. by another session), the second caller waits for the
+first's result rather than making a request of its own. Requests go through
+one requests.Session, so connections are kept alive and reused.
+'''
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CSE_URL = 'https://www.googleapis.com/customsearch/v1'
+
+
+class SearchClient:
+    def __init__(self, api_key, cx, num=10, ttl=3600, max_queries=1000, url=CSE_URL, timeout=10):
+        self.api_key = api_key
+        self.cx = cx
+        self.num = num
+        self.ttl = ttl
+        self.max_queries = max_queries
+        self.url = url
+        self.timeout = timeout
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.lock = Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+        self.logger = logging.getLogger('chat_log')
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def search(self, query):
+        '''
+        Returns the items found for the query, or [{"error_response": status}]
+        '''
+        key = ' '.join(query.lower().split())
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and time.monotonic() < cached[0]:
+                self.cache.move_to_end(key)
+                self.stats['hits'] += 1
+                self.logger.info(f'Search cache hit for "{key}"')
+                return cached[1]
+            future = self.in_flight.get(key)
+            if future is None:
+                future = Future()
+                self.in_flight[key] = future
+                owner = True
+                self.stats['misses'] += 1
+            else:
+                owner = False
+                self.stats['coalesced'] += 1
+
+        if not owner:
+            self.logger.info(f'Waiting on search already in flight for "{key}"')
+            return future.result()
+
+        try:
+            items = self.__request(query)
+        except Exception as ex:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(ex)
+            raise
+        with self.lock:
+            del self.in_flight[key]
+            # errors are not cached
+            if len(items) == 0 or 'error_response' not in items[0]:
+                self.cache[key] = (time.monotonic() + self.ttl, items)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.max_queries:
+                    self.cache.popitem(last=False)
+        future.set_result(items)
+        return items
+
+    def __request(self, query):
+        params = {"key": self.api_key,
+                  "cx": self.cx,
+                  "q": query,
+                  "num": self.num}
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        if response.status_code != 200:
+            self.logger.error(f'Search failed with status {response.status_code}')
+            return [{"error_response": response.status_code}]
+        return response.json().get('items', [])
+
+
+def test():
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from threading import Thread
+    from urllib.parse import urlsplit, parse_qs
+
+    requests_made = []
+
+    class StandInCSE(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlsplit(self.path).query)['q'][0]
+            requests_made.append(query)
+            time.sleep(0.2)
+            if query == 'fail':
+                self.send_response(500)
+                self.end_headers()
+                return
+            body = json.dumps({'items': [{'title': f'{query} {n}', 'link': f'http://example.com/{n}'}
+                                         for n in range(3)]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInCSE)
+    Thread(target=server.serve_forever, daemon=True).start()
+    client = SearchClient('key', 'cx', ttl=0.5, url=f'http://127.0.0.1:{server.server_port}/')
+
+    # the same query from 8 sessions at once makes one request
+    results = []
+    threads = [Thread(target=lambda indx=indx: results.append(
+        client.search('Weather in Moab' if indx % 2 else '  weather  in moab')))
+        for indx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(requests_made) == 1 and len(results) == 8
+    assert all(result == results[0] for result in results)
+
+    client.search('weather in Moab')
+    assert len(requests_made) == 1, 'cached query should not be requested again'
+    time.sleep(0.6)
+    client.search('weather in Moab')
+    assert len(requests_made) == 2, 'expired query should be requested again'
+
+    assert client.search('fail') == [{'error_response': 500}]
+    client.search('fail')
+    assert len(requests_made) == 4, 'errors should not be cached'
+    server.shutdown()
+    print(f'Search client OK: {len(requests_made)} requests, stats {client.stats}')
+
+if __name__ == '__main__':
+    test()
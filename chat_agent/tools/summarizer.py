@@ -0,0 +1,102 @@
+'''
+Map-reduce summarization of search results.
+
+The selected chunks are grouped by their source. If they all fit in one
+prompt, they are summarized in a single call. Otherwise each source is
+summarized on its own (map), concurrently in a pool of workers, and the
+summaries are then merged in a final call (reduce), itself done in rounds
+if the summaries are still too long for one prompt.
+
+Prompts hold only the text of the chunks and their references. Each is
+kept within the model's context ("max_context" less "max_tokens" of the
+chat configuration, less a margin for the instructions), counted with the
+model's tokenizer.
+'''
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+MAP_PROMPT = 'Write a detailed summary of the following information, from {reference}:\n\n{text}'
+REDUCE_PROMPT = ('Combine the following summaries of information from several sources into '
+                 'one detailed summary:\n\n{text}')
+STUFF_PROMPT = 'Write a detailed summary of the following information:\n\n{text}'
+
+
+class Summarizer:
+    def __init__(self, llm, workers=4, margin=64):
+        self.llm = llm
+        self.executor = ThreadPoolExecutor(workers)
+        max_context = llm.config.get('max_context', 4096)
+        max_tokens = llm.config.get('max_tokens', 256)
+        self.budget = max(max_context - max_tokens - margin, 64)
+        self.logger = logging.getLogger('chat_log')
+
+    def __call__(self, selections):
+        '''
+        Summarize (document, score) selections. Returns the summary and the
+        references, in ranked order
+        '''
+        # group chunks by source, sources ranked by how many chunks they gave
+        groups = defaultdict(list)
+        for document, _ in selections:
+            groups[document.metadata['reference']].append(document.page_content)
+        references = sorted(groups, key=lambda reference: len(groups[reference]), reverse=True)
+        sources = [self.__source(reference, '\n\n'.join(groups[reference]))
+                   for reference in references]
+
+        text = '\n\n'.join(sources)
+        if self.__count(STUFF_PROMPT, text) <= self.budget:
+            return self.__summarize(STUFF_PROMPT, text), references
+
+        # map: summarize each source (in parts, if it does not fit in one
+        # prompt) at once
+        parts = [(reference, part) for reference in references
+                 for part in self.__batches(groups[reference], MAP_PROMPT,
+                                            reference=self.__reference(reference))]
+        self.logger.info(f'Summarizing {len(sources)} sources in {len(parts)} parts')
+        summaries = list(self.executor.map(
+            lambda part: self.__source(part[0], self.__summarize(
+                MAP_PROMPT, '\n\n'.join(part[1]), reference=self.__reference(part[0]))),
+            parts))
+
+        # reduce: merge the summaries, in rounds if they do not fit in one
+        while len(summaries) > 1 and self.__count(REDUCE_PROMPT, '\n\n'.join(summaries)) > self.budget:
+            batches = self.__batches(summaries, REDUCE_PROMPT)
+            if len(batches) == len(summaries):
+                # no two summaries fit together; keep what fits
+                break
+            summaries = list(self.executor.map(
+                lambda batch: self.__summarize(REDUCE_PROMPT, '\n\n'.join(batch)), batches))
+        return self.__summarize(REDUCE_PROMPT, '\n\n'.join(summaries)), references
+
+    def __summarize(self, template, text, **kwargs):
+        prompt = template.format(text=self.__fit(template, text, **kwargs), **kwargs)
+        return self.llm([{'role': 'user', 'content': prompt}])
+
+    def __source(self, reference, text):
+        return f'Source: {self.__reference(reference)}\n{text}'
+
+    def __reference(self, reference):
+        title, link = reference
+        return f'{title} ({link})'
+
+    def __count(self, template, text, **kwargs):
+        return self.llm.tokenizer.count(template.format(text=text, **kwargs))
+
+    def __fit(self, template, text, **kwargs):
+        # cut text to the budget, if need be
+        excess = self.__count(template, text, **kwargs) - self.budget
+        if excess <= 0:
+            return text
+        tokens = self.llm.tokenizer.encode(text)
+        return self.llm.tokenizer.decode(tokens[:max(len(tokens) - excess, 0)])
+
+    def __batches(self, texts, template, **kwargs):
+        # consecutive texts, as many as fit in a prompt together
+        batches = [[]]
+        for text in texts:
+            if len(batches[-1]) > 0 and \
+                    self.__count(template, '\n\n'.join(batches[-1] + [text]), **kwargs) > self.budget:
+                batches.append([])
+            batches[-1].append(text)
+        return batches
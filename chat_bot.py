@@ -3,50 +3,67 @@ Implementation of a basic chatbot to use the agent. Can use either
 text (terminal) or voice.
 '''
 
+# imported first, so that the startup profile times from here
+from chat_agent.startup import timed, mark, report
+
 import sys
 import re
+import asyncio
 from threading import Thread
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
-from chat_agent.chatagent import ChatAgent
-from chat_agent.display_code import CodeDisplay
+from chat_agent.async_chatagent import AsyncChatAgent
 
 
 class Bot:
-    def __init__(self, voice=False, verbose=False):
+    def __init__(self, voice=False, verbose=False, profile=False):
+        self.voice = voice
+        self.profile = profile
+        self.tts = None
         if voice:
-            # initialize voice functions
-            print('Initializing speech...')
-            from voice.vosk_recognizer import SpeechRecognize
-            from voice.tts import Text2Speech
+            # the speech recognizer (the Vosk model) is loaded in the
+            # background, while the agent answers its first message
+            self.voice_loader = ThreadPoolExecutor(1, thread_name_prefix='voice')
+            self.recog = self.voice_loader.submit(self.__load_recognizer)
+            self.voice_loader.submit(self.__import_tts)
 
-            self.recog = SpeechRecognize()
-            self.tts = Text2Speech()
-            print('Done')
-        
-        self.voice = voice
-        self.chat_agent = ChatAgent(verbose=verbose)
+        with timed('agent'):
+            self.chat_agent = AsyncChatAgent(verbose=verbose)
 
-        self.message_queue = Queue()
+        # the agent runs on an event loop in the background, while we
+        # print or speak its messages
+        self.event_loop = asyncio.new_event_loop()
+        Thread(target=self.event_loop.run_forever, daemon=True).start()
 
     def loop(self):
         # start loop
         text = 'hello'
         while True:
-            message_thread = Thread(target=self.chat_agent, 
-                                    args=(text, self.message_queue))
-            message_thread.start()
+            message_queue = asyncio.Queue()
+            turn = asyncio.run_coroutine_threadsafe(self.chat_agent(text, message_queue),
+                                                    self.event_loop)
             done = False
+            profiled = False
             while not done:
-                message = self.message_queue.get()
+                message = asyncio.run_coroutine_threadsafe(message_queue.get(),
+                                                           self.event_loop).result()
+                if self.profile and not profiled:
+                    mark('first message')
+                    profiled = True
                 output = self.__filter_codeblocks(message[1])
+                done = message[0]
+                if len(output) == 0:
+                    continue
                 if self.voice:
                     print('\rtalking...     ', end='')
-                    self.tts.speak(output)
+                    self.__speak(output)
                 else:
                     print(f'AI: {output}\n')
-                done = message[0]
-            message_thread.join()
+            turn.result()
+            if self.profile:
+                mark('first response')
+                print(report())
+                self.profile = False
 
             if text.lower() == 'goodbye' or text.lower() == 'good bye':
                 break
@@ -55,18 +72,37 @@ class Bot:
                 text = ""
                 print('\rlistening...     ', end='')
                 while text == "":
-                    text = self.recog.speech_to_text()
+                    text = self.recog.result().speech_to_text()
             else:
                 text = input('Human: ')
                 
         print('\ndone!')
 
+    def __load_recognizer(self):
+        with timed('speech recognizer'):
+            from voice.vosk_recognizer import SpeechRecognize
+            return SpeechRecognize()
+
+    def __import_tts(self):
+        with timed('import text to speech'):
+            import voice.tts
+
+    def __speak(self, text):
+        # the speech engine is made in the thread which speaks, as pyttsx3's
+        # drivers expect
+        if self.tts is None:
+            with timed('text to speech'):
+                from voice.tts import Text2Speech
+                self.tts = Text2Speech()
+        self.tts.speak(text)
+
     def __filter_codeblocks(self, generated):
         # filter for code examples (delimited by ```). If so, display code in pop-up
         # window and replace it with "<displayed>" in user response
         pattern = r"```(.*?)```"
         matches = re.findall(pattern, generated, re.DOTALL)
         if matches:
+            from chat_agent.display_code import CodeDisplay
             for match in matches:
                 inner_text = f"```{match}```"
                 display = CodeDisplay()
@@ -75,7 +111,7 @@ class Bot:
         return generated
 
 def main():
-    params = {'novoice': False, 'verbose': False}
+    params = {'novoice': False, 'verbose': False, 'profile': False}
     if len(sys.argv) > 1:
         for arg in sys.argv[1:]:
             if arg in params.keys():
@@ -83,7 +119,8 @@ def main():
             else:
                 raise ValueError(f'Invalid command line argument "{arg}"')
     bot = Bot(voice=not params['novoice'], 
-              verbose=params['verbose'])
+              verbose=params['verbose'],
+              profile=params['profile'])
     bot.loop()
 
 if __name__ == '__main__':